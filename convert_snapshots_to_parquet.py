@@ -0,0 +1,55 @@
+from s3_read_write import S3ReadWrite
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+import logging, os
+
+
+def list_snapshots(s3, path):
+    """List the names of the csv snapshots stored under a path."""
+    prefix = '{}/{}/'.format(s3.folder, path)
+    paginator = s3.client.get_paginator('list_objects_v2')
+    names = []
+    for page in paginator.paginate(Bucket = s3.bucket, Prefix = prefix):
+        for obj in page.get('Contents', []):
+            name = obj['Key'][len(prefix):]
+            if '/' not in name and name.endswith('.csv'):
+                names.append(name[:-len('.csv')])
+    return sorted(names)
+
+
+def convert_snapshot(s3, path, name, row_group_size = 100000):
+    """Rewrite one csv snapshot as a Parquet object next to it."""
+    data = s3.read_from_S3_csv(path, name)
+    written = s3.put_dataframe_to_S3_parquet(path, name, data,
+        row_group_size = row_group_size)
+    logging.info('{}: {} rows, {:.1f} MB'.format(
+        written['key'], len(data), written['size'] / 2**20))
+    return written
+
+
+def main():
+    parser = ArgumentParser('Convert dated csv snapshots to Parquet')
+    parser.add_argument('--bucket', default = 'plated-data-science',
+        help = 'S3 bucket of the snapshots')
+    parser.add_argument('--folder', default = 'sample_input_data',
+        help = 'folder of the snapshots in the bucket')
+    parser.add_argument('--path', default = 'ETLV_v2',
+        help = 'path of the snapshots inside the folder')
+    parser.add_argument('--dates', nargs = '*',
+        help = 'snapshots to convert, all snapshots under the path by default')
+    parser.add_argument('--row_group_size', type = int, default = 100000,
+        help = 'number of rows per Parquet row group')
+    parser.add_argument('--max_workers', type = int,
+        default = min(8, os.cpu_count() or 1),
+        help = 'number of snapshots converted at once')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    s3 = S3ReadWrite(args.bucket, args.folder)
+    names = args.dates or list_snapshots(s3, args.path)
+    with ThreadPoolExecutor(max_workers = args.max_workers) as executor:
+        list(executor.map(lambda name: convert_snapshot(s3, args.path, name,
+            row_group_size = args.row_group_size), names))
+
+if __name__ == '__main__':
+    main()
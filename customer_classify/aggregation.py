@@ -0,0 +1,174 @@
+import pandas as pd
+import numpy as np
+import logging
+
+# the partial aggregates each aggregation is finalized from, and how two
+# partials of the same kind are merged
+_partials = {
+    'sum': ['sum'],
+    'count': ['count'],
+    'mean': ['sum', 'count'],
+    'max': ['max'],
+    'min': ['min'],
+    'any': ['max'],
+    'all': ['min']}
+
+_merges = {'sum': 'sum', 'count': 'sum', 'max': 'max', 'min': 'min'}
+
+
+def aggregation_spec(**features):
+    """Build an aggregation spec from lists of columns by aggregation, e.g.
+    aggregation_spec(sum = ['gov'], mean = ['gov', 'plates']).
+    Returns:
+        dict(list[str]): the aggregations of each column
+    """
+    spec = dict()
+    for aggregation, columns in features.items():
+        if aggregation not in _partials:
+            raise ValueError('unknown aggregation {}'.format(aggregation))
+        for col in columns:
+            spec.setdefault(col, []).append(aggregation)
+    return spec
+
+
+class PartialAggregates(object):
+    """Per-key aggregates of a table too large to hold in memory, built one
+    chunk at a time. Each chunk is reduced with a single grouped pass to
+    partial aggregates (sums, counts, maxima and minima), which merge with
+    the partials of earlier chunks; means, any and all are only derived
+    from them when the result is requested. Chunk partials are set aside
+    and only combined once they hold as many rows as the running partials,
+    so each key is regrouped a logarithmic number of times rather than
+    once per chunk. With an empty spec only the keys are kept.
+
+    Usage:
+        aggregates = PartialAggregates({'gov': ['sum', 'mean']})
+        for chunk in chunks:
+            aggregates.update(chunk)
+        features = aggregates.result()
+    """
+    def __init__(self, spec, keys = ('fold_end_date', 'internal_user_id')):
+        self.spec = spec
+        self.keys = list(keys)
+        self._partial = None
+        self._pending = []
+        self._n_pending = 0
+        self.n_rows = 0
+        self.partial_columns = {(col, partial): '{}__{}'.format(col, partial)
+            for col, aggregations in spec.items()
+            for aggregation in aggregations
+            for partial in _partials[aggregation]}
+
+    def update(self, chunk):
+        """Reduce a chunk of unaggregated rows and merge it into the partials.
+        Args:
+            chunk (Pandas.DataFrame): rows with the key columns and the
+                columns of the spec
+        """
+        if len(chunk) == 0:
+            return
+        self.n_rows += len(chunk)
+        values = chunk[self.keys].copy()
+        named = dict()
+        for (col, partial), name in self.partial_columns.items():
+            column = chunk[col]
+            if column.dtype.kind == 'b':
+                column = column.astype('int8')
+            values[name] = column
+            named[name] = pd.NamedAgg(column = name, aggfunc = partial)
+        grouped = values.groupby(self.keys, sort = False)
+        if named:
+            self.merge(grouped.agg(**named))
+        else:
+            self.merge(pd.DataFrame(index = grouped.size().index))
+
+    def merge(self, partial):
+        """Merge partial aggregates indexed by the keys into the running ones."""
+        self._pending.append(partial)
+        self._n_pending += len(partial)
+        if self._n_pending >= len(self._partial if self._partial is not None
+                else []):
+            self._combine()
+
+    @property
+    def partial(self):
+        """The partial aggregates of every chunk so far, indexed by the keys."""
+        if self._pending:
+            self._combine()
+        return self._partial
+
+    def _combine(self):
+        partials = ([self._partial] if self._partial is not None else []
+            ) + self._pending
+        self._pending = []
+        self._n_pending = 0
+        combined = pd.concat(partials) if len(partials) > 1 else partials[0]
+        if not self.partial_columns:
+            self._partial = combined[~combined.index.duplicated()]
+            return
+        self._partial = combined.groupby(level = self.keys, sort = False).agg(
+            {name: _merges[partial_name]
+                for (_, partial_name), name in self.partial_columns.items()})
+
+    def result(self):
+        """Finalize the partials into one column per column and aggregation,
+        named <column>_<aggregation>.
+        Returns:
+            Pandas.DataFrame: the aggregates indexed by the keys
+        """
+        if self.partial is None:
+            return pd.DataFrame(columns = self.keys).set_index(self.keys)
+        partial = self.partial
+        columns = dict()
+        for col, aggregations in self.spec.items():
+            def get(name):
+                return partial[self.partial_columns[(col, name)]]
+            for aggregation in aggregations:
+                if aggregation == 'mean':
+                    count = get('count')
+                    result = get('sum') / count.where(count > 0)
+                elif aggregation == 'any':
+                    result = get('max').fillna(0) > 0
+                elif aggregation == 'all':
+                    result = get('min').fillna(1) > 0
+                else:
+                    result = get(aggregation)
+                columns['{}_{}'.format(col, aggregation)] = result
+        logging.info('{} rows aggregated to {} keys'.format(
+            self.n_rows, len(partial)))
+        return pd.DataFrame(columns, index = partial.index).sort_index()
+
+
+def assign_folds(data, input_dates, date_col):
+    """Repeat each row once for every fold whose input window contains its
+    date, tagged with the fold's end date. Windows are (start, end], so
+    overlapping folds each get a copy of the rows they share.
+    Args:
+        data (Pandas.DataFrame): unaggregated rows with a date column
+        input_dates (list[tuple(datetime)]): (start, end) of each input period
+        date_col (str): the column holding the date of each row
+    Returns:
+        Pandas.DataFrame: the rows with a fold_end_date column added
+    """
+    windows = sorted(input_dates, key = lambda dates: dates[1])
+    starts = np.array([pd.Timestamp(s) for s, _ in windows],
+        dtype = 'datetime64[ns]')
+    ends = np.array([pd.Timestamp(e) for _, e in windows],
+        dtype = 'datetime64[ns]')
+    if (np.diff(starts).astype('int64') < 0).any():
+        raise ValueError('input windows must not nest inside each other')
+    dates = pd.to_datetime(data[date_col]).to_numpy(dtype = 'datetime64[ns]')
+
+    # folds containing a date are contiguous once windows are sorted: from
+    # the first one ending on or after it to the last one starting before it
+    first = np.searchsorted(ends, dates, side = 'left')
+    last = np.searchsorted(starts, dates, side = 'left')
+    n_copies = np.maximum(last - first, 0)
+    rows = np.repeat(np.arange(len(data)), n_copies)
+    offsets = np.arange(len(rows)) - np.repeat(
+        np.cumsum(n_copies) - n_copies, n_copies)
+    folds = np.repeat(first, n_copies) + offsets
+
+    result = data.iloc[rows].reset_index(drop = True)
+    result['fold_end_date'] = ends[folds]
+    return result
@@ -0,0 +1,175 @@
+import pandas as pd
+import numpy as np
+import logging, threading
+
+# rough in-memory size of one raw value as returned by the database driver
+# (a python object plus its slot in the row tuple) before it is compacted
+RAW_BYTES_PER_VALUE = 64
+
+
+class ColumnBuffer(object):
+    """Preallocated column arrays for a model matrix whose rows are known in
+    advance, filled chunk by chunk as tables are streamed from the database.
+    Each chunk is written into its rows by index position, so tables can
+    arrive in any order and need no join afterwards. Rows a table never
+    fills are left missing.
+
+    Usage:
+        buffer = ColumnBuffer(cohort_index, {'tbl': ['a', 'b']}, dtypes)
+        for chunk in chunks:
+            buffer.append('tbl', chunk)
+        data = buffer.to_frame()
+    """
+    def __init__(self, index, table_columns, dtypes):
+        self.index = index
+        self.n_rows = len(index)
+        self.table_columns = table_columns
+        self.dtypes = dtypes
+        self.columns = dict()
+        self.categories = dict()
+        self.filled = {tbl: np.zeros(self.n_rows, dtype = bool)
+            for tbl in table_columns}
+        self._lock = threading.Lock()
+        for cols in table_columns.values():
+            for col in cols:
+                if dtypes.get(col) is not None:
+                    self._allocate(col, dtypes[col])
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.columns.values())
+
+    @staticmethod
+    def estimate_bytes(n_rows, dtypes, columns):
+        """Estimate the size of the filled buffer before allocating it.
+        Args:
+            n_rows (int): number of rows in the buffer
+            dtypes (dict(str)): compact dtypes of the columns
+            columns (list[str]): names of all columns in the buffer
+        Returns:
+            int: the estimated size of the buffer in bytes
+        """
+        itemsizes = [4 if dtypes.get(col) == 'category'
+            else np.dtype(dtypes[col]).itemsize if dtypes.get(col)
+            else 8 for col in columns]
+        return n_rows * sum(itemsizes)
+
+    def append(self, tbl, chunk):
+        """Write a chunk of a table into the rows of the buffer it belongs to.
+        Rows of the chunk that are not in the buffer's index are skipped.
+        Args:
+            tbl (str): the name of the table the chunk was read from
+            chunk (Pandas.DataFrame): rows of the table, indexed like the buffer
+        """
+        positions = self.index.get_indexer(chunk.index)
+        keep = positions >= 0
+        positions = positions[keep]
+        filled = self.filled[tbl]
+        if filled[positions].any():
+            raise ValueError('{} returned more than one row for some '
+                'applicants'.format(tbl))
+        filled[positions] = True
+
+        for col in self.table_columns[tbl]:
+            values = chunk[col]
+            if col not in self.columns:
+                with self._lock:
+                    self._allocate(col, values.dtype)
+            if (col not in self.categories
+                    and self.columns[col].dtype.kind in 'iub'
+                    and values.isnull().any()):
+                self._upcast(col)
+            if col in self.categories:
+                self.columns[col][positions] = self._encode(col, values)[keep]
+                continue
+            self.columns[col][positions] = values.to_numpy()[keep]
+
+    def to_frame(self):
+        """Assemble the filled column arrays into a dataframe, marking the rows
+        a table never filled as missing.
+        Returns:
+            Pandas.DataFrame: the model matrix indexed like the buffer
+        """
+        for tbl, filled in self.filled.items():
+            if filled.all():
+                continue
+            logging.info('{} missing for {} of {} rows'.format(
+                tbl, (~filled).sum(), self.n_rows))
+            for col in self.table_columns[tbl]:
+                # categorical codes are int32 but already have a missing code
+                if (col not in self.categories
+                        and self.columns[col].dtype.kind in 'iub'):
+                    self._upcast(col)
+                if col in self.categories:
+                    self.columns[col][~filled] = -1
+                else:
+                    self.columns[col][~filled] = (np.nan
+                        if self.columns[col].dtype.kind == 'f' else None)
+
+        data = dict()
+        for cols in self.table_columns.values():
+            for col in cols:
+                if col in self.categories:
+                    data[col] = pd.Categorical.from_codes(self.columns[col],
+                        categories = list(self.categories[col]))
+                else:
+                    data[col] = self.columns[col]
+        return pd.DataFrame(data, index = self.index, copy = False)
+
+    def _allocate(self, col, dtype):
+        if col in self.columns:
+            return
+        if str(dtype) == 'category':
+            self.categories[col] = dict()
+            self.columns[col] = np.full(self.n_rows, -1, dtype = 'int32')
+        elif np.dtype(dtype).kind == 'f':
+            self.columns[col] = np.full(self.n_rows, np.nan, dtype = dtype)
+        else:
+            self.columns[col] = np.empty(self.n_rows, dtype = dtype)
+
+    def _upcast(self, col):
+        values = self.columns[col]
+        if values.dtype.kind == 'b':
+            # missing flags are kept as a categorical with a missing level
+            self.categories[col] = {False: 0, True: 1}
+            self.columns[col] = values.astype('int32')
+        elif values.dtype.kind in 'iu':
+            self.columns[col] = values.astype(
+                'float32' if values.dtype.itemsize <= 2 else 'float64')
+
+    def _encode(self, col, values):
+        """Translate the codes of a chunk's categorical column into codes of
+        the buffer's running list of categories."""
+        values = pd.Categorical(values)
+        levels = self.categories[col]
+        with self._lock:
+            for level in values.categories:
+                levels.setdefault(level, len(levels))
+        lookup = np.array([levels[level] for level in values.categories],
+            dtype = 'int32')
+        codes = values.codes
+        return np.where(codes >= 0, lookup[np.maximum(codes, 0)], -1)
+
+
+def chunk_rows_for_budget(memory_budget, buffer_bytes, n_columns,
+        max_workers = 1, min_rows = 1000, max_rows = 200000):
+    """Choose how many rows to read at a time so that the raw chunks being
+    read concurrently fit in the memory left over once the buffer is
+    allocated.
+    Args:
+        memory_budget (int): total bytes available for reading the data
+        buffer_bytes (int): bytes taken by the preallocated buffer
+        n_columns (int): number of columns in the widest table
+        max_workers (int): number of tables read at the same time
+        min_rows (int): smallest chunk to read
+        max_rows (int): largest chunk to read
+    Returns:
+        int: number of rows per chunk
+    """
+    if buffer_bytes >= memory_budget:
+        raise MemoryError('model matrix needs {:.1f} GB which exceeds the '
+            'memory budget of {:.1f} GB'.format(
+                buffer_bytes / 2**30, memory_budget / 2**30))
+    row_bytes = RAW_BYTES_PER_VALUE * (n_columns + 2) * max(1, max_workers)
+    rows = (memory_budget - buffer_bytes) // row_bytes
+    return int(min(max_rows, max(min_rows, rows)))
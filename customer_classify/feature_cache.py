@@ -0,0 +1,131 @@
+import pandas as pd
+import os, json, time, hashlib, logging, threading
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class FeatureCache(object):
+    """An on-disk Parquet cache of feature tables pulled from the database,
+    keyed by the feature table, the columns pulled from it, and the query
+    defining the cohort. Each entry also stores the result of a cheap
+    freshness probe run against the database (the last update time of the
+    tables behind the feature view and the size of the staged cohort); an
+    entry is only reused if the probe still matches and the entry is younger
+    than the time-to-live. The least recently used entries are evicted once
+    the cache grows past max_bytes.
+
+    Usage:
+        cache = FeatureCache('~/.cache/customer_propensity/features')
+        data = cache.get(key, freshness)
+        if data is None:
+            data = pull_from_database()
+            cache.put(key, data, freshness)
+    """
+    index_name = 'index.json'
+
+    def __init__(self, cache_dir, max_bytes = 20 * 2**30, ttl = 7 * 24 * 3600,
+            refresh = False):
+        if pyarrow is None:
+            raise ImportError('FeatureCache requires pyarrow to be installed')
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok = True)
+        self._index = self._read_index()
+
+    def __str__(self):
+        return '(cache_dir: {}, entries: {}, hits: {}, misses: {})'.format(
+            self.cache_dir, len(self._index), self.hits, self.misses)
+
+    @staticmethod
+    def key(feature_tbl, columns, cohort_query):
+        """Build the cache key for one pull of a feature table.
+        Args:
+            feature_tbl (str): the full name of the feature table or view
+            columns (list[str]): the columns pulled (or excluded) from the table
+            cohort_query (str): the query defining the applicants of interest
+        Returns:
+            str: a hex digest identifying the pull
+        """
+        cohort_hash = hashlib.sha1(
+            ' '.join(cohort_query.split()).encode('utf-8')).hexdigest()
+        description = json.dumps([feature_tbl, sorted(columns or []),
+            cohort_hash])
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def get(self, key, freshness):
+        """Return the cached dataframe for a key, or None if it is missing,
+        older than the time-to-live, or stale according to the probe.
+        Args:
+            key (str): a cache key built with FeatureCache.key
+            freshness (list): the current result of the freshness probe
+        Returns:
+            pandas.DataFrame: the cached data or None
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            usable = (entry is not None and not self.refresh
+                and time.time() - entry['created'] < self.ttl
+                and entry['freshness'] == freshness
+                and os.path.exists(self._path(key)))
+            if not usable:
+                self.misses += 1
+                return None
+            entry['last_access'] = time.time()
+            self.hits += 1
+            self._write_index()
+        return pd.read_parquet(self._path(key))
+
+    def put(self, key, data, freshness):
+        """Write a dataframe to the cache and evict old entries if needed.
+        Args:
+            key (str): a cache key built with FeatureCache.key
+            data (pandas.DataFrame): the pulled feature data
+            freshness (list): the result of the freshness probe at pull time
+        """
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        data.to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+        now = time.time()
+        with self._lock:
+            self._index[key] = {'bytes': os.path.getsize(path),
+                'created': now, 'last_access': now, 'freshness': freshness}
+            self._evict()
+            self._write_index()
+
+    def _evict(self):
+        total = sum(entry['bytes'] for entry in self._index.values())
+        by_access = sorted(self._index.items(),
+            key = lambda item: item[1]['last_access'])
+        for key, entry in by_access:
+            if total <= self.max_bytes:
+                break
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+            del self._index[key]
+            total -= entry['bytes']
+            logging.info('evicted {} from feature cache'.format(key))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.parquet'.format(key))
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.index_name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def _write_index(self):
+        path = os.path.join(self.cache_dir, self.index_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self._index, f)
+        os.replace(path + '.tmp', path)
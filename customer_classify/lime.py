@@ -2,6 +2,7 @@ import eduanalytics
 from eduanalytics import model_data, pipeline_tools, reporting
 from lime import lime_tabular
 import pandas as pd
+from scipy import sparse
 from sklearn import preprocessing
 from collections import namedtuple
 
@@ -86,6 +87,8 @@ def impute_numeric(data, numeric_dict, imputer, encoder):
     imputed_data = data.copy()
     transformed_and_imputed = imputer.transform(
         encoder.transform(data))
+    if sparse.issparse(transformed_and_imputed):
+        transformed_and_imputed = transformed_and_imputed.toarray()
 
     for raw_index, imputed_index in numeric_dict.items():
         imputed_data.iloc[:,raw_index] = transformed_and_imputed[:,imputed_index]
@@ -107,10 +110,9 @@ def transform_data(data, categorical_cols, colnames):
     dtypes = {col: 'category' if col in categorical_cols else 'float'
               for col in colnames}
     transformed_data = transformed_data.astype(dtypes)
-    encoder_new = pipeline_tools.DummyEncoder()
+    encoder_new = pipeline_tools.DummyEncoder(sparse = False)
     encoder_new.fit(transformed_data)
-    transformed_data = encoder_new.transform(transformed_data)
-    return transformed_data.as_matrix()
+    return encoder_new.transform(transformed_data)
 
 
 ### Running Lime
@@ -1,6 +1,12 @@
 import pandas as pd
 import string, os, re, logging
 import yaml, json, itertools
+import time, uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from customer_classify.column_buffer import ColumnBuffer, chunk_rows_for_budget
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelBinarizer
 
@@ -21,41 +27,166 @@ def convert_categorical(data):
     return data_categorical
 
 
-def describe_model(filename, engine):
+# smallest pandas dtypes holding each MySQL integer type, signed and unsigned
+_integer_dtypes = {'tinyint': ('int8', 'int16'), 'smallint': ('int16', 'int32'),
+    'mediumint': ('int32', 'int32'), 'int': ('int32', 'int64'),
+    'integer': ('int32', 'int64'), 'bigint': ('int64', 'uint64')}
+_string_types = {'char', 'varchar', 'enum', 'set',
+    'tinytext', 'text', 'mediumtext', 'longtext'}
+_float_types = {'float', 'double', 'decimal', 'numeric', 'real'}
+_schema_catalogs = dict()
+
+
+def compact_dtype(data_type, column_type, is_nullable):
+    """Map a MySQL column type to the most compact pandas dtype that holds its
+    values without loss and that the modeling pipeline can consume.
+    Args:
+        data_type (str): the data_type from information_schema.columns
+        column_type (str): the column_type from information_schema.columns,
+            e.g. tinyint(1) or int(10) unsigned
+        is_nullable (str): YES or NO from information_schema.columns
+    Returns:
+        str: a pandas dtype, or None to keep the dtype pandas infers
+    """
+    data_type, column_type = data_type.lower(), column_type.lower()
+    nullable = is_nullable.upper() == 'YES'
+
+    if column_type.startswith('tinyint(1)'):
+        # flags keep an explicit missing level when nullable
+        return 'category' if nullable else 'bool'
+    if data_type in _string_types:
+        return 'category'
+    if data_type in _float_types:
+        return 'float32'
+    if data_type in _integer_dtypes:
+        if nullable:
+            # NULLs need a float, and float32 is exact up to 24 bit integers
+            return 'float32' if data_type in (
+                'tinyint', 'smallint', 'mediumint') else 'float64'
+        signed, unsigned = _integer_dtypes[data_type]
+        return unsigned if 'unsigned' in column_type else signed
+    return None
+
+
+def get_schema_catalog(features_dict, engine):
+    """Look up the columns of each feature table and their compact dtypes in
+    information_schema. The catalog is cached per database and set of feature
+    tables, so it is queried once per process.
+    Args:
+        features_dict (dict(list[str])): a dictionary where the keys are the
+            names of the feature tables
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+    Returns:
+        Pandas.DataFrame: one row per feature column with table_name,
+            column_name and dtype, in table order
+    """
+    feature_tbls = sorted("vw$features${}".format(tbl_name)
+        for tbl_name in features_dict.keys())
+    catalog_key = (str(engine.url), tuple(feature_tbls))
+    if catalog_key not in _schema_catalogs:
+        column_query = """select table_name, column_name,
+            data_type, column_type, is_nullable
+        from information_schema.columns
+        where table_schema = database()
+        and table_name in ({feature_string})
+        and column_name not in ('aamc_id', 'application_year')
+        order by table_name, ordinal_position;""".format(
+            feature_string = ", ".join(
+                "'{}'".format(tbl) for tbl in feature_tbls))
+
+        catalog = pd.read_sql_query(column_query, engine)
+        catalog.columns = catalog.columns.str.lower()
+        catalog['dtype'] = [compact_dtype(*col_info) for col_info in zip(
+            catalog.data_type, catalog.column_type, catalog.is_nullable)]
+        _schema_catalogs[catalog_key] = catalog
+    return _schema_catalogs[catalog_key]
+
+
+def get_feature_columns(features_dict, engine):
+    """Resolve the exact list of columns to pull from each feature table from
+    the database schema, leaving out the index columns and any columns the
+    model specification excludes.
+    Args:
+        features_dict (dict(list[str])): a dictionary where the keys are the
+            names of the feature tables and the values are lists of names of
+            columns that should be excluded for each table
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+    Returns:
+        dict(list[str]): a dictionary where the keys are the full names of the
+            feature tables and the values are lists of the columns to pull
+            from each table in table order
+    """
+    catalog = get_schema_catalog(features_dict, engine)
+    feature_tbls = {"vw$features${}".format(tbl_name): cols_to_drop
+        for tbl_name, cols_to_drop
+        in features_dict.items()}
+    return {feature_tbl: [col for col in
+            catalog.column_name[catalog.table_name == feature_tbl]
+            if col not in set(drop_cols or [])]
+        for feature_tbl, drop_cols in feature_tbls.items()}
+
+
+def get_feature_dtypes(features_dict, engine):
+    """Return the compact dtype to convert each feature column to on read.
+    Args:
+        features_dict (dict(list[str])): a dictionary where the keys are the
+            names of the feature tables
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+    Returns:
+        dict(str): column names mapped to pandas dtypes
+    """
+    catalog = get_schema_catalog(features_dict, engine)
+    catalog = catalog[catalog.dtype.notnull()]
+    return dict(zip(catalog.column_name, catalog.dtype))
+
+
+def concat_compact(chunks):
+    """Concatenate chunks of compacted data read from the database, aligning
+    the categories of each categorical column across chunks so the result
+    stays categorical instead of falling back to object.
+    Args:
+        chunks (list[Pandas.DataFrame]): chunks sharing the same columns
+    Returns:
+        Pandas.DataFrame: the concatenated data
+    """
+    if not chunks:
+        return pd.DataFrame()
+    if len(chunks) == 1:
+        return chunks[0]
+    for col in chunks[0]:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            categories = pd.Index(sorted(set(itertools.chain(
+                *(chunk[col].cat.categories for chunk in chunks)))))
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks)
+
+
+def describe_model(filename, engine, search_opts = None):
     """Reads in a new model specification file, parses it, and appends a basic
-    description of the model (including a list of all its features) to the
-    algorithms table of the database.
+    description of the model (including a list of all its features and the
+    hyperparameter search used to fit it) to the algorithms table of the
+    database.
     Args:
         filename (str): a path to the model specification file in yaml format
         engine (sqlalchemy.Engine): a connection to the MySQL database
+        search_opts (dict): the search strategy and budget of the fit
     Returns:
         dict: the model options specified in the file in dictionary format
         int: the algorithm id for the model just added
+        dict(list[str]): the columns to pull from each feature table
     """
     with open(filename) as f:
         model_opts = yaml.load(f)
 
     algorithm_name = model_opts['algorithm_name']
-    algorithm_description = json.dumps(model_opts)
+    algorithm_description = json.dumps(dict(model_opts, search = search_opts)
+        if search_opts else model_opts)
 
-    feature_tbls = {"'vw$features${}'".format(tbl_name): cols_to_drop
-        for tbl_name, cols_to_drop
-        in model_opts['features'].items()}
-
-    column_query = """select column_name
-    from information_schema.columns
-    where table_name in ({feature_string})
-    and column_name not in ('aamc_id', 'application_year');""".format(
-        feature_string = ", ".join(feature_tbls.keys()))
-
-    column_names = pd.read_sql_query(column_query, engine)
-    column_names = set(column_names.column_name)
-    drop_cols = set(itertools.chain(*feature_tbls.values()))
-
-    if drop_cols:
-        column_names = column_names - drop_cols
+    feature_columns = get_feature_columns(model_opts['features'], engine)
+    column_names = list(itertools.chain(*feature_columns.values()))
 
-    algorithm_details = json.dumps(list(column_names))
+    algorithm_details = json.dumps(column_names)
 
     x = pd.DataFrame({'algorithm_name': [algorithm_name],
             'algorithm_description': [algorithm_description],
@@ -64,10 +195,29 @@ def describe_model(filename, engine):
 
     algorithm_id = pd.read_sql_query('select max(id) from algorithm',
         engine).iloc[0,0]
-    return model_opts, algorithm_id
+    return model_opts, algorithm_id, feature_columns
 
 
-def get_data_for_modeling(filename, engine):
+def get_fit_columns(engine, algorithm_id):
+    """Look up the feature columns an algorithm was fit on, as recorded in the
+    algorithms table by describe_model.
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        algorithm_id (int): the algorithm id of the fitted model
+    Returns:
+        list[str]: the names of the feature columns in the order they were
+            pulled for fitting
+    """
+    details = pd.read_sql_query(text("""select algorithm_details
+        from algorithm where id = :alg_id"""), engine,
+        params = {'alg_id': int(algorithm_id)})
+    if details.empty:
+        raise ValueError('no algorithm with id {}'.format(algorithm_id))
+    return json.loads(details.iloc[0, 0])
+
+
+def get_data_for_modeling(filename, engine, max_workers = None, cache = None,
+        memory_budget = None, search_opts = None):
     """Return a dataframe containing features specified by the yaml file for
     records meeting the cohort criteria specified in the yaml file.
     Includes the true outcome label from the database.
@@ -75,13 +225,23 @@ def get_data_for_modeling(filename, engine):
         filename (str): path to YAML file with cohort, outcome, and
             feature specification for desired model data
         engine (sqlalchemy.Engine): a connection to the MySQL database
+        max_workers (int): number of feature tables to pull concurrently,
+            overrides the max_workers option in the yaml file (default 1)
+        cache (FeatureCache): an optional local cache of previously pulled
+            feature tables (not used when streaming)
+        memory_budget (float): if given, stream the feature tables in chunks
+            into a preallocated buffer using at most this many gigabytes,
+            overrides the memory_budget_gb option in the yaml file
+        search_opts (dict): the hyperparameter search options, recorded in
+            the algorithm description
     Returns:
         Pandas.DataFrame: dataframe with Multi-index of aamc id and application year
             for applicants with known outcomes and qualifying cohort variables
         int: the algorithm id for the model specified by the file
         str: the algorithm name for the model specified by the file
     """
-    model_opts, algorithm_id = describe_model(filename, engine)
+    model_opts, algorithm_id, feature_columns = describe_model(
+        filename, engine, search_opts = search_opts)
 
     cohort_vals = model_opts['cohorts']['included']
     get_cohort = """select aamc_id, application_year
@@ -92,28 +252,46 @@ def get_data_for_modeling(filename, engine):
             cohort_col = model_opts['cohorts']['col'],
             cohort_vals = ",".join(["'{}'".format(i) for i in cohort_vals]))
 
-    get_outcomes = """select *
-        from `vw$outcomes${outcome_tbl}`
-        where (aamc_id, application_year) in
-        ({cohort_query})""".format(
-            outcome_tbl = model_opts['outcomes'],
-            cohort_query = get_cohort)
+    with StagedCohort(engine, get_cohort) as cohort:
+        get_outcomes = """select o.*
+            from `vw$outcomes${outcome_tbl}` o
+            inner join `{cohort_tbl}` c
+            using (aamc_id, application_year)""".format(
+                outcome_tbl = model_opts['outcomes'],
+                cohort_tbl = cohort.name)
 
-    outcome_data = pd.read_sql_query(get_outcomes, engine,
-        index_col = ['aamc_id', 'application_year'])
+        outcome_data = convert_categorical(pd.read_sql_query(
+            get_outcomes, engine,
+            index_col = ['aamc_id', 'application_year']))
 
-    features = loop_through_features(engine, model_opts['features'],
-        subquery = get_cohort)
+        max_workers = max_workers or model_opts.get('max_workers', 1)
+        memory_budget = memory_budget or model_opts.get('memory_budget_gb')
+        dtypes = get_feature_dtypes(model_opts['features'], engine)
+        start_time = time.time()
+        if memory_budget:
+            model_data = stream_through_features(engine, feature_columns,
+                cohort_tbl = cohort.name,
+                memory_budget = int(memory_budget * 2**30),
+                max_workers = max_workers, dtypes = dtypes,
+                outcome_data = outcome_data)
+        else:
+            features = loop_through_features(engine, feature_columns,
+                cohort_tbl = cohort.name, max_workers = max_workers,
+                cache = cache, cohort_query = get_cohort, dtypes = dtypes)
+            # feature columns are already compacted on read
+            model_data = outcome_data.join(features)
+        cohort.log_comparison(time.time() - start_time)
+    if cache is not None and not memory_budget:
+        logging.info("feature cache {}".format(str(cache)))
 
-    model_data = outcome_data.join(features)
-    model_data = convert_categorical(model_data)
     logging.info("pulled training/validation data for {n} applicants in {ncol} features".format(
         n = model_data.shape[0], ncol = model_data.shape[1] - 1))
     return model_data, algorithm_id, model_opts['algorithm_name']
 
 
 def get_data_for_prediction(filename, engine, algorithm_id,
-        prediction_tbl = "out$predictions$screening_current_cohort"):
+        prediction_tbl = "out$predictions$screening_current_cohort",
+        max_workers = None, memory_budget = None):
     """Return a dataframe for the desired data for members of the current data
     for whom predictions have not already been generated containing the features
     specified in the model yaml file.
@@ -125,9 +303,15 @@ def get_data_for_prediction(filename, engine, algorithm_id,
             and used to generate predictions
         prediction_tbl (str): the name of the table where previous predictions
             have been written
+        max_workers (int): number of feature tables to pull concurrently,
+            overrides the max_workers option in the yaml file (default 1)
+        memory_budget (float): if given, stream the feature tables in chunks
+            into a preallocated buffer using at most this many gigabytes,
+            overrides the memory_budget_gb option in the yaml file
     Returns:
         Pandas.DataFrame: dataframe with Multi-index (aamc id, application year)
-            for applicants with known outcomes and qualifying cohort variables
+            for applicants with known outcomes and qualifying cohort variables,
+            holding the feature columns the algorithm was fit on in fit order
     """
     with open(filename) as f:
         model_opts = yaml.load(f)
@@ -141,63 +325,392 @@ def get_data_for_prediction(filename, engine, algorithm_id,
             cohort_col = model_opts['cohorts']['col'],
             cohort_vals = ",".join(["'{}'".format(i) for i in cohort_vals]))
 
-    current_applicants_query = """select aamc_id, application_year
-        from `vw$filtered${eligible_tbl}`
-        where (aamc_id, application_year, {alg_id}) not in
-        (select aamc_id, application_year, algorithm_id
-        from `{prediction_tbl}`)
-        and (aamc_id, application_year) in
-        ({cohort_query})""".format(
-            eligible_tbl = model_opts['predictions'],
-            alg_id = algorithm_id,
-            prediction_tbl = prediction_tbl,
-            cohort_query = get_cohort)
-    n_applicants = pd.read_sql_query(
-        current_applicants_query, engine).shape[0]
-    if n_applicants == 0:
-        return pd.DataFrame()
+    if ensure_prediction_index(engine, prediction_tbl):
+        # anti-join against the scored keys of this algorithm only, which the
+        # index answers without scanning the history of other algorithms
+        current_applicants_query = """select e.aamc_id, e.application_year
+            from `vw$filtered${eligible_tbl}` e
+            inner join ({cohort_query}) c
+            using (aamc_id, application_year)
+            left join `{prediction_tbl}` p
+            on p.algorithm_id = {alg_id}
+            and p.aamc_id = e.aamc_id
+            and p.application_year = e.application_year
+            where p.aamc_id is null""".format(
+                eligible_tbl = model_opts['predictions'],
+                alg_id = algorithm_id,
+                prediction_tbl = prediction_tbl,
+                cohort_query = get_cohort)
+    else:
+        current_applicants_query = """select e.aamc_id, e.application_year
+            from `vw$filtered${eligible_tbl}` e
+            inner join ({cohort_query}) c
+            using (aamc_id, application_year)""".format(
+                eligible_tbl = model_opts['predictions'],
+                cohort_query = get_cohort)
+    with StagedCohort(engine, current_applicants_query) as cohort:
+        if cohort.n_applicants == 0:
+            return pd.DataFrame()
 
-    features = loop_through_features(engine, model_opts['features'],
-        subquery = current_applicants_query)
+        # pull exactly the columns the model was fit on, whatever was added
+        # to the feature views since
+        fit_columns = get_fit_columns(engine, algorithm_id)
+        keep = set(fit_columns)
+        feature_columns = {feature_tbl: [col for col in columns if col in keep]
+            for feature_tbl, columns in get_feature_columns(
+                model_opts['features'], engine).items()}
+        feature_columns = {feature_tbl: columns
+            for feature_tbl, columns in feature_columns.items() if columns}
+        missing = keep - set(itertools.chain(*feature_columns.values()))
+        if missing:
+            logging.warning('{} columns the model was fit on are no longer in '
+                'the feature tables and are left missing: {}'.format(
+                len(missing), ', '.join(sorted(missing))))
+        max_workers = max_workers or model_opts.get('max_workers', 1)
+        memory_budget = memory_budget or model_opts.get('memory_budget_gb')
+        dtypes = get_feature_dtypes(model_opts['features'], engine)
+        start_time = time.time()
+        if memory_budget:
+            current_data = stream_through_features(engine, feature_columns,
+                cohort_tbl = cohort.name,
+                memory_budget = int(memory_budget * 2**30),
+                max_workers = max_workers, dtypes = dtypes)
+        else:
+            features = loop_through_features(engine, feature_columns,
+                cohort_tbl = cohort.name, max_workers = max_workers,
+                dtypes = dtypes)
+            current_data = features[0].join(features[1:])
+        cohort.log_comparison(time.time() - start_time)
+    current_data = current_data.reindex(columns = fit_columns)
 
-    current_data = features[0].join(features[1:])
     logging.info(
         "pulled new testing data for {n} applicants in {ncol} features".format(
         n = current_data.shape[0], ncol = current_data.shape[1]))
     return current_data
 
 
-def loop_through_features(engine, features_dict, subquery):
+def ensure_prediction_index(engine, prediction_tbl,
+        index_name = 'scored_keys'):
+    """Make sure the predictions table has an index on the keys each algorithm
+    has already scored, so that finding unscored applicants is an indexed
+    anti-join whose cost does not grow with the history of predictions.
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        prediction_tbl (str): the name of the table where previous predictions
+            have been written
+        index_name (str): the name of the scored keys index
+    Returns:
+        bool: whether the predictions table exists (it is created on the first
+            write of predictions)
+    """
+    table_query = """select count(*) from information_schema.tables
+        where table_schema = database() and table_name = :tbl"""
+    index_query = """select count(*) from information_schema.statistics
+        where table_schema = database() and table_name = :tbl
+        and index_name = :index_name"""
+    with engine.begin() as connection:
+        if not connection.execute(text(table_query),
+                {'tbl': prediction_tbl}).scalar():
+            return False
+        if not connection.execute(text(index_query),
+                {'tbl': prediction_tbl, 'index_name': index_name}).scalar():
+            connection.execute(text("""create index `{index_name}`
+                on `{tbl}` (algorithm_id, aamc_id, application_year)""".format(
+                    index_name = index_name, tbl = prediction_tbl)))
+            logging.info("created index {} on {}".format(
+                index_name, prediction_tbl))
+    return True
+
+
+class StagedCohort(object):
+    """Materializes the aamc_id and application_year of a cohort query once
+    into an indexed table so that the outcome and feature queries can join
+    against it instead of re-evaluating the cohort query for every table.
+    A regular table (dropped on exit) is used rather than a temporary table
+    so that it is visible to every connection in the engine's pool.
+
+    Usage:
+        with StagedCohort(engine, cohort_query) as cohort:
+            # join feature tables against cohort.name
+    """
+    def __init__(self, engine, cohort_query, prefix = 'tmp$cohort'):
+        self.engine = engine
+        self.cohort_query = cohort_query
+        self.name = '{}${}'.format(prefix, uuid.uuid4().hex[:12])
+        self.n_applicants = None
+        self.build_time = None
+
+    def __enter__(self):
+        create_cohort = """create table `{cohort_tbl}`
+            (primary key (aamc_id, application_year))
+            select distinct aamc_id, application_year
+            from ({cohort_query}) cohort""".format(
+                cohort_tbl = self.name,
+                cohort_query = self.cohort_query)
+        count_cohort = "select count(*) from `{}`".format(self.name)
+
+        start_time = time.time()
+        with self.engine.begin() as connection:
+            connection.execute(text(create_cohort))
+            self.n_applicants = connection.execute(
+                text(count_cohort)).scalar()
+        self.build_time = time.time() - start_time
+        logging.info("staged cohort of {n} applicants in {cohort_tbl}".format(
+            n = self.n_applicants, cohort_tbl = self.name))
+        return self
+
+    def log_comparison(self, feature_time):
+        logging.info("cohort built in {cohort:.1f}s, "
+            "feature tables pulled in {features:.1f}s".format(
+                cohort = self.build_time, features = feature_time))
+
+    def __exit__(self, type, value, traceback):
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "drop table if exists `{}`".format(self.name)))
+
+
+def feature_query(feature_tbl, columns, cohort_tbl):
+    """Build the query pulling the given columns of a feature table for the
+    applicants in the staged cohort table.
+    Args:
+        feature_tbl (str): the full name of the feature table or view
+        columns (list[str]): names of the feature columns to pull
+        cohort_tbl (str): name of the staged cohort table
+    Returns:
+        str: the feature query
     """
+    return """select f.aamc_id, f.application_year{column_string}
+    from `{feature_tbl}` f
+    inner join `{cohort_tbl}` c
+    using (aamc_id, application_year)""".format(
+        column_string = "".join(", f.`{}`".format(col) for col in columns),
+        feature_tbl = feature_tbl,
+        cohort_tbl = cohort_tbl)
+
+
+def probe_freshness(engine, feature_tbl, cohort_tbl):
+    """Run a cheap query whose result changes when a cached pull of the
+    feature table for the cohort would be out of date: the last update time
+    information_schema keeps for the base tables behind the feature view
+    (all base tables of the schema other than the staging and output tables
+    written by the runs themselves, where the server does not expose view
+    dependencies), which also moves on in-place updates, and the size of
+    the staged cohort. The session's information_schema statistics are
+    refreshed first, as MySQL 8 otherwise serves update times up to a day
+    old.
     Args:
         engine (sqlalchemy.Engine): a connection to the mySQL database
-        features_dict (dict(list[str])): a dictionary where the keys are the
-            names of the feature tables and the values are lists of names of
-            columns that should be excluded for each table (may be empty to
-            include all features in the table)
-        subquery (str): a string containing the subquery giving the aamc_id and
+        feature_tbl (str): the full name of the feature table or view
+        cohort_tbl (str): name of the staged cohort table
+    Returns:
+        list: the last update time of the feature data as a string and the
+            row count of the cohort table, or None if the update time is
+            unknown and the cache cannot be trusted
+    """
+    base_tables = """select max(update_time) from information_schema.tables
+        where table_schema = database() and table_type = 'BASE TABLE'"""
+    behind_view = base_tables + """ and (table_name = :tbl or table_name in (
+            select table_name from information_schema.view_table_usage
+            where view_schema = database() and view_name = :tbl))"""
+    # staged cohorts, predictions and the algorithm table change every run
+    feature_tables = base_tables + """ and table_name not like 'tmp$%'
+        and table_name not like 'out$%' and table_name <> 'algorithm'"""
+    with engine.connect() as connection:
+        try:
+            connection.execute(text(
+                'set session information_schema_stats_expiry = 0'))
+        except DBAPIError:
+            # before MySQL 8 update times are not cached
+            pass
+        try:
+            updated = connection.execute(text(behind_view),
+                {'tbl': feature_tbl}).scalar()
+        except DBAPIError:
+            # view_table_usage only exists from MySQL 8.0.13
+            updated = None
+        if updated is None:
+            updated = connection.execute(text(feature_tables)).scalar()
+        n_cohort = connection.execute(text(
+            'select count(*) from `{}`'.format(cohort_tbl))).scalar()
+    if updated is None:
+        return None
+    return [str(updated), int(n_cohort)]
+
+
+def fetch_feature_table(engine, feature_tbl, columns, cohort_tbl,
+        cache = None, cohort_query = None, dtypes = None, chunksize = 50000):
+    """Pull a single feature table for the applicants of interest, selecting
+    only the requested columns.
+    Args:
+        engine (sqlalchemy.Engine): a connection to the mySQL database
+        feature_tbl (str): the full name of the feature table or view
+        columns (list[str]): names of the feature columns to pull
+        cohort_tbl (str): name of the staged table holding the aamc_id and
             application_year of the applicants of interest
+        cache (FeatureCache): an optional local cache of previous pulls
+        cohort_query (str): the query the cohort table was staged from, used
+            to identify the pull in the cache
+        dtypes (dict(str)): compact dtypes to convert columns to while reading
+            (see get_feature_dtypes)
+        chunksize (int): number of rows to read and convert at a time
+    Returns:
+        pandas.DataFrame: the features in the table indexed by aamc_id and
+            application_year
+    """
+    dtypes = {col: dtypes[col] for col in columns if col in (dtypes or {})}
+    if cache is not None:
+        key = cache.key(feature_tbl, columns, cohort_query or cohort_tbl)
+        freshness = probe_freshness(engine, feature_tbl, cohort_tbl)
+        feature_data = (cache.get(key, freshness)
+            if freshness is not None else None)
+        if feature_data is not None:
+            logging.info("read {} from the feature cache".format(feature_tbl))
+            return feature_data.astype(dtypes)
+
+    get_features = feature_query(feature_tbl, columns, cohort_tbl)
+    # convert each chunk as it arrives so the full frame is never held with
+    # the object and float64 dtypes pandas would infer
+    feature_data = concat_compact([chunk.astype(dtypes) for chunk in
+        pd.read_sql_query(get_features, engine,
+            index_col = ['aamc_id', 'application_year'],
+            chunksize = chunksize)])
+    if cache is not None and freshness is not None:
+        cache.put(key, feature_data, freshness)
+    return feature_data
+
+
+def loop_through_features(engine, feature_columns, cohort_tbl, max_workers = 1,
+        cache = None, cohort_query = None, dtypes = None):
+    """
+    Args:
+        engine (sqlalchemy.Engine): a connection to the mySQL database. When
+            pulling concurrently, each worker checks out its own connection
+            from the engine's pool, so the pool should allow at least
+            max_workers connections
+        feature_columns (dict(list[str])): a dictionary where the keys are the
+            full names of the feature tables and the values are lists of names
+            of the columns to pull from each table (see get_feature_columns)
+        cohort_tbl (str): name of the staged table holding the aamc_id and
+            application_year of the applicants of interest (see StagedCohort)
+        max_workers (int): maximum number of feature tables to pull at once,
+            tables are pulled one at a time if 1 or less
+        cache (FeatureCache): an optional local cache of previous pulls, each
+            table is read from the cache if an up-to-date copy exists
+        cohort_query (str): the query the cohort table was staged from, used
+            to identify pulls in the cache
+        dtypes (dict(str)): compact dtypes to convert columns to while reading
+            (see get_feature_dtypes)
     Returns:
         list(pandas.DataFrame): a list of dataframes containing all the features
             specified in the feature dictionary for all the applicants returned
-            by the given subquery
+            in the cohort table, in the order given by the feature dictionary
     """
-    feature_tbls = {"vw$features${}".format(tbl_name): cols_to_drop
-        for tbl_name, cols_to_drop
-        in features_dict.items()}
+    fetch = partial(fetch_feature_table, engine, cohort_tbl = cohort_tbl,
+        cache = cache, cohort_query = cohort_query, dtypes = dtypes)
+
+    if not max_workers or max_workers <= 1:
+        return [fetch(feature_tbl, columns)
+            for feature_tbl, columns in feature_columns.items()]
+
+    features = dict()
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        pending = {executor.submit(fetch, feature_tbl, columns): feature_tbl
+            for feature_tbl, columns in feature_columns.items()}
+        for future in as_completed(pending):
+            feature_tbl = pending[future]
+            features[feature_tbl] = future.result()
+            logging.info("pulled {tbl} ({n} of {total} feature tables)".format(
+                tbl = feature_tbl, n = len(features), total = len(pending)))
+    # keep the column order of the specification regardless of arrival order
+    return [features[feature_tbl] for feature_tbl in feature_columns]
+
+
+def stream_feature_table(engine, feature_tbl, columns, cohort_tbl, buffer,
+        dtypes = None, chunksize = 50000):
+    """Stream a feature table from the database with a server-side cursor,
+    compacting each chunk and writing it into a preallocated buffer.
+    Args:
+        engine (sqlalchemy.Engine): a connection to the mySQL database
+        feature_tbl (str): the full name of the feature table or view
+        columns (list[str]): names of the feature columns to pull
+        cohort_tbl (str): name of the staged cohort table
+        buffer (ColumnBuffer): the buffer holding the model matrix
+        dtypes (dict(str)): compact dtypes to convert columns to while reading
+        chunksize (int): number of rows to fetch from the cursor at a time
+    """
+    dtypes = {col: dtypes[col] for col in columns if col in (dtypes or {})}
+    get_features = feature_query(feature_tbl, columns, cohort_tbl)
+    with engine.connect() as connection:
+        chunks = pd.read_sql_query(get_features,
+            connection.execution_options(stream_results = True),
+            index_col = ['aamc_id', 'application_year'],
+            chunksize = chunksize)
+        for chunk in chunks:
+            buffer.append(feature_tbl, chunk.astype(dtypes))
+
+
+def stream_through_features(engine, feature_columns, cohort_tbl, memory_budget,
+        max_workers = 1, dtypes = None, outcome_data = None):
+    """Streaming counterpart to loop_through_features that keeps peak memory
+    close to the size of the final model matrix. The matrix is preallocated
+    for every applicant and each feature table is streamed into its columns
+    in chunks sized to fit in the memory budget, so no table is ever held
+    in full and no join is needed.
+    Args:
+        engine (sqlalchemy.Engine): a connection to the mySQL database
+        feature_columns (dict(list[str])): a dictionary where the keys are the
+            full names of the feature tables and the values are lists of names
+            of the columns to pull from each table (see get_feature_columns)
+        cohort_tbl (str): name of the staged cohort table
+        memory_budget (int): bytes available for the matrix and the chunks
+            being read
+        max_workers (int): maximum number of feature tables to pull at once
+        dtypes (dict(str)): compact dtypes to convert columns to while reading
+        outcome_data (Pandas.DataFrame): optional outcome columns, if given
+            the matrix holds only the applicants with a known outcome and
+            these columns come first
+    Returns:
+        Pandas.DataFrame: all features for the applicants in the cohort table
+    """
+    dtypes = dtypes or dict()
+    if outcome_data is not None:
+        index = outcome_data.index
+    else:
+        index = pd.read_sql_query(
+            "select aamc_id, application_year from `{}`".format(cohort_tbl),
+            engine, index_col = ['aamc_id', 'application_year']).index
+
+    table_columns = dict()
+    if outcome_data is not None:
+        table_columns['outcomes'] = list(outcome_data.columns)
+    table_columns.update(feature_columns)
+    buffer_bytes = ColumnBuffer.estimate_bytes(len(index), dtypes,
+        list(itertools.chain(*table_columns.values())))
+    chunksize = chunk_rows_for_budget(memory_budget, buffer_bytes,
+        n_columns = max(len(cols) for cols in feature_columns.values()),
+        max_workers = max_workers)
+    logging.info("streaming {n} feature tables into a {size:.2f} GB buffer "
+        "in chunks of {rows} rows".format(n = len(feature_columns),
+            size = buffer_bytes / 2**30, rows = chunksize))
+
+    buffer = ColumnBuffer(index, table_columns, dtypes)
+    if outcome_data is not None:
+        buffer.append('outcomes', outcome_data)
 
-    features = list()
-    for feature_tbl, drop_cols in feature_tbls.items():
-        get_features = """select * from `{feature_tbl}`
-        where (aamc_id, application_year) in ({query})""".format(
-            feature_tbl = feature_tbl,
-            query = subquery)
-        feature_data = pd.read_sql_query(get_features, engine,
-            index_col = ['aamc_id', 'application_year'])
-        if drop_cols:
-            feature_data.drop(drop_cols, axis = 1, inplace = True)
-        features.append(feature_data)
-    return features
+    stream = partial(stream_feature_table, engine, cohort_tbl = cohort_tbl,
+        buffer = buffer, dtypes = dtypes, chunksize = chunksize)
+    if not max_workers or max_workers <= 1:
+        for feature_tbl, columns in feature_columns.items():
+            stream(feature_tbl, columns)
+    else:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            pending = {executor.submit(stream, feature_tbl, columns): feature_tbl
+                for feature_tbl, columns in feature_columns.items()}
+            for future in as_completed(pending):
+                future.result()
+                logging.info("streamed {}".format(pending[future]))
+    return buffer.to_frame()
 
 
 def split_data(model_matrix, outcome_name = 'outcome',
@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import pandas as pd
+import numpy as np
+import logging
+
+date_fmt = '%Y-%m-%d'
+
+
+def fold_dates(end_date, n_folds, offset, step = None):
+    """List the (input date, outcome date) pairs of the folds for one
+    cancellation horizon. Outcome dates go back from end_date by step days,
+    and each input date is offset days before its outcome date, so horizons
+    built with the same step share most of their snapshots.
+    Args:
+        end_date (str): latest outcome date YYYY-MM-DD
+        n_folds (int): number of folds
+        offset (int): days between the input and the outcome snapshot
+        step (int): days between consecutive folds, offset by default
+    Returns:
+        list[tuple(str)]: (input date, outcome date) pairs, latest first
+    """
+    step = step or offset
+    end_date = datetime.strptime(end_date, date_fmt)
+    outcome_dates = [end_date - timedelta(days = step * i)
+        for i in range(n_folds)]
+    return [((outcome - timedelta(days = offset)).strftime(date_fmt),
+        outcome.strftime(date_fmt)) for outcome in outcome_dates]
+
+
+def sorted_ids(data, id_col = 'internal_user_id'):
+    """Reduce a snapshot to the sorted array of the unique user ids in it."""
+    return np.unique(data[id_col].to_numpy(dtype = 'int64'))
+
+
+def still_active(input_ids, outcome_ids):
+    """Flag which of the sorted input ids also appear in the sorted outcome ids.
+    Args:
+        input_ids (numpy.ndarray): sorted unique ids at the input date
+        outcome_ids (numpy.ndarray): sorted unique ids at the outcome date
+    Returns:
+        numpy.ndarray: boolean mask aligned with input_ids
+    """
+    if len(outcome_ids) == 0:
+        return np.zeros(len(input_ids), dtype = bool)
+    positions = np.searchsorted(outcome_ids, input_ids)
+    positions[positions == len(outcome_ids)] = 0
+    return outcome_ids[positions] == input_ids
+
+
+def load_user_ids(s3, path, dates, max_workers = 8):
+    """Read the user ids of every dated snapshot once, keeping only their
+    sorted unique integer arrays in memory.
+    Args:
+        s3 (S3ReadWrite): reader of the snapshots
+        path (str): path of the snapshots inside the folder, e.g. ETLV_v2
+        dates (iterable[str]): the snapshot dates to read
+        max_workers (int): maximum number of snapshots read at once
+    Returns:
+        dict(numpy.ndarray): sorted user ids by snapshot date
+    """
+    return {date: sorted_ids(data)
+        for date, data in s3.read_many(path, sorted(set(dates)),
+            max_workers = max_workers, reader = s3.read_columns,
+            columns = ['internal_user_id'])}
+
+
+def build_labels(user_ids, folds_by_offset, max_workers = 8, output = None):
+    """Label every (input, outcome) pair of every horizon from the preloaded
+    user ids, computing the pairs in parallel.
+    Args:
+        user_ids (dict(numpy.ndarray)): sorted user ids by snapshot date
+        folds_by_offset (dict(list)): (input date, outcome date) pairs keyed
+            by the horizon in days, as returned by fold_dates
+        max_workers (int): maximum number of pairs labelled at once
+        output (callable): if given, called with (offset, input date,
+            labels) as each pair is done instead of keeping the labels
+    Returns:
+        dict(Pandas.DataFrame): internal_user_id and canceled for each
+            (offset, input date), empty when output is given
+    """
+    def label(input_date, outcome_date):
+        input_ids = user_ids[input_date]
+        return pd.DataFrame({'internal_user_id': input_ids,
+            'canceled': ~still_active(input_ids, user_ids[outcome_date])})
+
+    labels = dict()
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        pending = {executor.submit(label, input_date, outcome_date):
+            (offset, input_date)
+            for offset, folds in folds_by_offset.items()
+            for input_date, outcome_date in folds}
+        for future in as_completed(pending):
+            offset, input_date = pending[future]
+            data = future.result()
+            logging.info('{} of {} users canceled within {} days of {}'.format(
+                data.canceled.sum(), len(data), offset, input_date))
+            if output is None:
+                labels[(offset, input_date)] = data
+            else:
+                output(offset, input_date, data)
+    return labels
+
+
+def write_labels(s3_input, s3_output, input_path, end_date, n_folds,
+        offsets, step = None, max_workers = 8):
+    """Build and write the cancellation labels for several horizons in one
+    pass, reading each snapshot once however many folds and horizons use it.
+    Labels are written to canceled_within_<offset>_days/<input date>.
+    Args:
+        s3_input (S3ReadWrite): reader of the snapshots
+        s3_output (S3ReadWrite): writer of the labels
+        input_path (str): path of the snapshots, e.g. ETLV_v2
+        end_date (str): latest outcome date YYYY-MM-DD
+        n_folds (int): number of folds per horizon
+        offsets (list[int]): the horizons in days, e.g. [7, 14, 28]
+        step (int): days between consecutive folds, the smallest offset
+            by default
+        max_workers (int): maximum number of snapshots read or pairs
+            labelled at once
+    """
+    step = step or min(offsets)
+    folds_by_offset = {offset: fold_dates(end_date, n_folds, offset, step)
+        for offset in offsets}
+    dates = [date for folds in folds_by_offset.values()
+        for pair in folds for date in pair]
+    user_ids = load_user_ids(s3_input, input_path, dates,
+        max_workers = max_workers)
+    logging.info('user ids loaded for {} snapshots'.format(len(user_ids)))
+
+    def output(offset, input_date, data):
+        s3_output.put_dataframe_to_S3(
+            'canceled_within_{}_days'.format(offset), input_date, data)
+
+    build_labels(user_ids, folds_by_offset, max_workers = max_workers,
+        output = output)
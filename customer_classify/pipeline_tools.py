@@ -1,7 +1,10 @@
 from sklearn.pipeline import TransformerMixin
 from sklearn.base import BaseEstimator
+import joblib
+from scipy import sparse
 import pandas as pd
-import re, yaml, logging
+import numpy as np
+import re, os, yaml, logging, shutil, tempfile
 import time, datetime
 
 def extract_step_from_pipeline(cv_pipeline, step_name):
@@ -107,38 +110,161 @@ def build_param_grid(pipeline, grid_path):
     return param_grid
 
 
+def build_search_options(grid_path):
+    """Reads the search section of the grid options yaml file, which chooses
+    how the parameter grid is searched:
+        search:
+          strategy: halving   # exhaustive (default), randomized or halving
+          budget: 40          # candidates sampled (randomized, halving)
+          cv: 5
+          resource: n_samples # halving: or e.g. randomforestclassifier__n_estimators
+          factor: 3
+          warm_start: true    # exhaustive: grow forests across n_estimators
+          temporal:           # validate on later dates instead of cv folds
+            date_level: input_date
+            window: expanding # or sliding, with train_dates
+            gap: 7
+            n_splits: 3
+    Args:
+        grid_path: path to a yaml file containing the grid options to use
+    Returns:
+        dict: the search options with defaults filled in
+    """
+    with open(grid_path, 'r') as f:
+        grid = yaml.load(f)
+    search_opts = {'strategy': 'exhaustive', 'cv': 5}
+    search_opts.update(grid.get('search') or dict())
+    if search_opts['strategy'] == 'randomized' and not search_opts.get('budget'):
+        raise ValueError('a randomized search needs a budget (n_iter)')
+    return search_opts
+
+
 class DummyEncoder(BaseEstimator, TransformerMixin):
     """A one-hot encoder transformer with fit and transform methods.
     Suitable for use in a pipeline. Adds indicator variables for NAs,
-    drops dummy for first level of categorical.
+    keeps a dummy for every level of categorical. The levels seen in fit are
+    the vocabulary: each maps to a fixed output column, named and ordered
+    like pandas.get_dummies, and missing or unseen levels go to the
+    <column>_nan dummy. Transform returns a float32 scipy.sparse CSR matrix,
+    or a dense float32 array if sparse is False.
     Usage:
         d = DummyEncoder().fit(X_train)
         X_train_enc, X_test_enc = d.transform(X_train), d.transform(X_test)
     """
-    def __init__(self):
+    def __init__(self, sparse = True):
+        self.sparse = sparse
         self.columns = None
         self.transformed_columns = None
 
+    def __setstate__(self, state):
+        # encoders pickled before the vocabulary have no sparse option
+        state.setdefault('sparse', False)
+        super(DummyEncoder, self).__setstate__(state)
+
     def transform(self, X, y=None, **kwargs):
-        transformed = pd.get_dummies(X,
-            columns = self.columns,
-            drop_first = False, # do not drop in transform method!
-            dummy_na = True)
-        transformed = transformed.loc[:,self.transformed_columns]
-        return transformed
+        if not hasattr(self, 'vocabulary_'):
+            # fitted before the vocabulary existed (an older pickled model),
+            # so encode as it was fitted: a dense frame of its dummies
+            transformed = pd.get_dummies(X,
+                columns = self.columns,
+                drop_first = False,
+                dummy_na = True)
+            return transformed.reindex(columns = self.transformed_columns,
+                fill_value = 0)
+        n_rows = X.shape[0]
+        n_numeric = len(self.numeric_columns_)
+        # one entry per numeric column and one dummy per categorical column
+        indices = np.empty((n_rows, n_numeric + len(self.columns)),
+            dtype = 'int32')
+        values = np.ones(indices.shape, dtype = 'float32')
+        indices[:, :n_numeric] = np.arange(n_numeric)
+        values[:, :n_numeric] = X[self.numeric_columns_].to_numpy(
+            dtype = 'float32')
+        for i, col in enumerate(self.columns):
+            levels, start = self.vocabulary_[col]
+            codes = levels.get_indexer(X[col])
+            indices[:, n_numeric + i] = start + np.where(
+                codes >= 0, codes, len(levels))
+
+        shape = (n_rows, len(self.transformed_columns))
+        if not self.sparse:
+            transformed = np.zeros(shape, dtype = 'float32')
+            transformed[np.arange(n_rows)[:, None], indices] = values
+            return transformed
+        keep = values != 0
+        indptr = np.zeros(n_rows + 1, dtype = 'int64')
+        np.cumsum(keep.sum(axis = 1), out = indptr[1:])
+        return sparse.csr_matrix((values[keep], indices[keep], indptr),
+            shape = shape)
 
     def fit(self, X, y=None, **kwargs):
         self.columns = X.select_dtypes(
             include = ['object', 'category']).columns
+        self.numeric_columns_ = X.columns.drop(self.columns)
 
-        transformed = pd.get_dummies(X,
-            columns = self.columns,
-            drop_first = False, # need to be careful about dropping this
-            dummy_na = True)
-        self.transformed_columns = transformed.columns
+        self.vocabulary_ = dict()
+        transformed_columns = list(self.numeric_columns_)
+        for col in self.columns:
+            levels = pd.Categorical(X[col]).categories
+            self.vocabulary_[col] = (levels, len(transformed_columns))
+            transformed_columns.extend('{}_{}'.format(col, level)
+                for level in levels)
+            transformed_columns.append('{}_nan'.format(col))
+        self.transformed_columns = pd.Index(transformed_columns)
         return self
 
 
+class PreprocessingCache(object):
+    """A local disk store for the fitted preprocessing steps of a Pipeline,
+    passed as its memory. A transformer fitted with the same parameters on
+    the same data (e.g. the same CV fold for another classifier candidate)
+    is loaded from disk instead of being refitted. Works across the worker
+    processes of a grid search, since hits and misses are counted from the
+    entries in the store rather than in memory.
+
+    Usage:
+        cache = PreprocessingCache()
+        pipeline = make_pipeline(..., memory = cache.memory)
+        n_entries = cache.n_entries()
+        grid_search.fit(X, y)
+        cache.log_stats(n_entries, n_fits * n_transformers)
+        cache.cleanup()
+    """
+    def __init__(self, cache_dir = None, verbose = 0):
+        self.temporary = cache_dir is None
+        self.cache_dir = (tempfile.mkdtemp(prefix = 'preprocessing_')
+            if self.temporary else os.path.expanduser(cache_dir))
+        self.memory = joblib.Memory(self.cache_dir, verbose = verbose)
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return '(cache_dir: {}, entries: {}, hits: {}, misses: {})'.format(
+            self.cache_dir, self.n_entries(), self.hits, self.misses)
+
+    def n_entries(self):
+        """Number of fitted steps stored so far."""
+        return sum('output.pkl' in files
+            for _, _, files in os.walk(self.cache_dir))
+
+    def log_stats(self, entries_before, n_calls):
+        """Work out and log the hits and misses of a fit.
+        Args:
+            entries_before (int): n_entries() before the fit
+            n_calls (int): number of preprocessing step fits the fit asked for
+        """
+        misses = self.n_entries() - entries_before
+        self.misses += misses
+        self.hits += max(n_calls - misses, 0)
+        logging.info('preprocessing cache: {} of {} step fits reused'.format(
+            max(n_calls - misses, 0), n_calls))
+
+    def cleanup(self):
+        """Remove the store if it was a temporary one."""
+        if self.temporary:
+            shutil.rmtree(self.cache_dir, ignore_errors = True)
+
+
 class Timer(object):
     """A Timer object that begins timing when entered and ends timing adding
     elapsed time to a log when exited.
@@ -1,7 +1,9 @@
 import pandas as pd
 import numpy as np
 from eduanalytics import model_data, pipeline_tools
-import os, fnmatch
+import os, fnmatch, logging
+import tempfile, time, csv
+from sqlalchemy import text
 from sklearn.externals import joblib
 
 def get_results(clf, X, y, lb):
@@ -77,7 +79,7 @@ def convert_binary_predictions(scores, lb, ids):
 
 
 def output_predictions(train_results, test_results, conn,
-    alg_id = -1, tbl_name = 'screening_train_val'):
+    alg_id = -1, tbl_name = 'screening_train_val', batch_size = 50000):
     """Write the true labels and prediction scores to a table in the database.
     Args:
         train_results (Pandas.DataFrame): indexed true and predicted output for
@@ -88,6 +90,7 @@ def output_predictions(train_results, test_results, conn,
         alg_id (int): an algorithm id to store the model results by
         tbl_name (str): a name for the database table holding all results on
             the training and validation data
+        batch_size (int): number of rows written per batch
     Returns:
         str: the name of the table in the database
     """
@@ -96,13 +99,14 @@ def output_predictions(train_results, test_results, conn,
     test_results['set'] = 'test'
     results = pd.concat([train_results, test_results])
     results['algorithm_id'] = alg_id
-    results.to_sql(name, conn, if_exists = 'append',
-        index_label = results.index.names)
-    return "Added to database {}: algorithm_id = {}".format(name, alg_id)
+    rate = bulk_write(results, name, conn, batch_size = batch_size)
+    return "Added to database {}: algorithm_id = {} ({:,.0f} rows/s)".format(
+        name, alg_id, rate)
 
 
 def write_current_predictions(clf, filename, conn, label_encoder, alg_id,
-        tbl_name = 'screening_current_cohort'):
+        tbl_name = 'screening_current_cohort', max_workers = None,
+        memory_budget = None, batch_size = 50000):
     """Write out the predictions for the new testing data, only if (aamc_id,
     application_year) does not already have a prediction score for that
     algorithm_id, including the overall score (pr(invite) - pr(reject))
@@ -117,10 +121,15 @@ def write_current_predictions(clf, filename, conn, label_encoder, alg_id,
             generate the predictions
         tbl_name (str): name of table in database where predictions for all
             current applicants are written to
+        max_workers (int): number of feature tables to pull concurrently
+        memory_budget (float): if given, stream the feature tables using at
+            most this many gigabytes
+        batch_size (int): number of rows written per batch
     Returns:
         str: output message confirming predictions have been written correctly
     """
-    current_data = model_data.get_data_for_prediction(filename, conn, alg_id)
+    current_data = model_data.get_data_for_prediction(filename, conn, alg_id,
+        max_workers = max_workers, memory_budget = memory_budget)
     if current_data.empty:
         return "No new applicant data for algorithm_id = {}".format(alg_id)
     results = get_results(clf, current_data, y = None, lb = label_encoder)
@@ -128,9 +137,77 @@ def write_current_predictions(clf, filename, conn, label_encoder, alg_id,
     name = "out$predictions${}".format(tbl_name)
     results = results.assign(algorithm_id = alg_id,
         score = lambda x: np.round(x.predicted_invite - x.predicted_reject, 2))
-    results.to_sql(name, conn, if_exists = 'append',
-        index_label = results.index.names)
-    return "Added to database {}: algorithm_id = {}".format(name, alg_id)
+    rate = bulk_write(results, name, conn, batch_size = batch_size)
+    return "Added to database {}: algorithm_id = {} ({:,.0f} rows/s)".format(
+        name, alg_id, rate)
+
+
+def bulk_write(results, name, conn, batch_size = 50000, local_infile = True):
+    """Append a dataframe to a table by staging it to a local TSV file and
+    loading it with LOAD DATA LOCAL INFILE, falling back to large multi-row
+    inserts if the server or driver does not allow it (the engine has to be
+    created with connect_args = {'local_infile': True} for pymysql).
+    Args:
+        results (Pandas.DataFrame): indexed data to append, the index is
+            written as columns like DataFrame.to_sql would
+        name (str): the name of the table, created if it does not exist
+        conn (sqlalchemy.Engine): connection to the MySQL database
+        batch_size (int): number of rows serialized or inserted per batch
+        local_infile (bool): whether to try LOAD DATA LOCAL INFILE at all
+    Returns:
+        float: the number of rows written per second
+    """
+    start_time = time.time()
+    results = results.astype({col: 'int8' for col in results
+        if results[col].dtype == bool})
+    # create the table exactly as to_sql would if it does not exist yet,
+    # including the index on the index columns
+    results.head(0).to_sql(name, conn, if_exists = 'append')
+    data = results.reset_index()
+
+    loaded = False
+    if local_infile:
+        f = tempfile.NamedTemporaryFile('w', suffix = '.tsv', delete = False)
+        try:
+            # backslashes are the escape character of LOAD DATA, and values
+            # holding tabs, newlines or quotes are enclosed in double quotes
+            escaped = data.copy()
+            for col in escaped:
+                if pd.api.types.is_string_dtype(escaped[col].dtype):
+                    escaped[col] = escaped[col].map(lambda value:
+                        value.replace('\\', '\\\\')
+                        if isinstance(value, str) else value)
+            with f:
+                escaped.to_csv(f, sep = '\t', header = False, index = False,
+                    na_rep = '\\N', chunksize = batch_size,
+                    quoting = csv.QUOTE_MINIMAL, quotechar = '"',
+                    doublequote = True)
+            load_data = """load data local infile '{path}'
+                into table `{name}`
+                fields terminated by '\\t' optionally enclosed by '"'
+                    escaped by '\\\\'
+                lines terminated by '\\n'
+                ({columns})""".format(
+                    path = f.name.replace('\\', '/'),
+                    name = name,
+                    columns = ", ".join("`{}`".format(col) for col in data))
+            with conn.begin() as connection:
+                connection.execute(text(load_data))
+            loaded = True
+        except Exception as e:
+            logging.warning("LOAD DATA LOCAL INFILE into {} failed, "
+                "falling back to multi-row inserts: {}".format(name, e))
+        finally:
+            os.remove(f.name)
+
+    if not loaded:
+        data.to_sql(name, conn, if_exists = 'append', index = False,
+            chunksize = batch_size, method = 'multi')
+
+    rate = data.shape[0] / max(time.time() - start_time, 1e-6)
+    logging.info("wrote {n} rows to {name} at {rate:,.0f} rows/s".format(
+        n = data.shape[0], name = name, rate = rate))
+    return rate
 
 
 def pickle_model(clf, pkl_path, label_encoder, alg_id, model_tag):
@@ -0,0 +1,338 @@
+from sklearn.base import BaseEstimator, clone, is_classifier
+from sklearn.pipeline import Pipeline
+from sklearn.model_selection import (GridSearchCV, RandomizedSearchCV,
+    ParameterGrid, ParameterSampler, check_cv)
+from sklearn.metrics import check_scoring
+from joblib import Parallel, delayed
+import numpy as np
+import math, numbers, logging
+
+STRATEGIES = ('exhaustive', 'randomized', 'halving')
+
+N_ESTIMATORS = 'randomforestclassifier__n_estimators'
+
+RANDOM_STATE = 'randomforestclassifier__random_state'
+
+
+def _take(data, indices):
+    return data.iloc[indices] if hasattr(data, 'iloc') else data[indices]
+
+
+def _stratified_order(y, train, rng):
+    """Shuffle the train rows so that every prefix holds the classes in
+    about the proportions of the whole fold, and the first rows hold one of
+    each class: rows are ordered by their relative position in a shuffle of
+    their own class."""
+    train = rng.permutation(train)
+    labels = np.asarray(y)[train]
+    if labels.ndim > 1:
+        labels = labels.argmax(axis = 1)
+    _, classes, counts = np.unique(labels, return_inverse = True,
+        return_counts = True)
+    classes = classes.ravel()
+    position = np.empty(len(train))
+    for label, count in enumerate(counts):
+        position[classes == label] = np.arange(count) / float(count)
+    return train[np.argsort(position, kind = 'mergesort')]
+
+
+def _fit_and_score(estimator, params, X, y, train, test, scorer):
+    """Fit a clone of the estimator with the given parameters on the train
+    rows and score it on the test rows."""
+    estimator = clone(estimator).set_params(**params)
+    estimator.fit(_take(X, train), _take(y, train))
+    return scorer(estimator, _take(X, test), _take(y, test))
+
+
+def _grow_and_score(estimator, params, n_estimators, X, y, train, test,
+        scorer):
+    """Fit the preprocessing steps of a pipeline once, then grow its forest
+    with warm start through each of the sizes, scoring it at every size."""
+    estimator = clone(estimator).set_params(**params)
+    X_train, y_train = _take(X, train), _take(y, train)
+    X_test, y_test = _take(X, test), _take(y, test)
+    forest = estimator
+    if isinstance(estimator, Pipeline):
+        forest = estimator.steps[-1][1]
+        if len(estimator.steps) > 1:
+            preprocessing = Pipeline(estimator.steps[:-1],
+                memory = estimator.memory)
+            X_train = preprocessing.fit_transform(X_train, y_train)
+            X_test = preprocessing.transform(X_test)
+    forest.set_params(warm_start = True)
+    scores = []
+    for size in n_estimators:
+        forest.set_params(n_estimators = size)
+        forest.fit(X_train, y_train)
+        scores.append(scorer(forest, X_test, y_test))
+    return scores
+
+
+class BaseIncrementalSearch(BaseEstimator):
+    """Shared parts of the searches that do not fit every candidate on all
+    of the data: cross-validation splits, scoring, a GridSearchCV-like
+    cv_results_, refitting the best candidate on all the data and
+    delegating predictions to it. Subclasses implement _search, returning
+    one record per evaluated candidate with its params, per-fold scores and
+    any extra columns for cv_results_.
+    """
+    def __init__(self, estimator, param_grid, scoring = None, cv = 5,
+            n_jobs = None, refit = True, verbose = 0, random_state = None):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.scoring = scoring
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.refit = refit
+        self.verbose = verbose
+        self.random_state = random_state
+
+    def fit(self, X, y = None):
+        cv = check_cv(self.cv, y, classifier = is_classifier(self.estimator))
+        splits = list(cv.split(X, y))
+        self.n_splits_ = len(splits)
+        self.scorer_ = check_scoring(self.estimator, scoring = self.scoring)
+
+        records = self._search(X, y, splits)
+        self.cv_results_ = self._results(records)
+        best = self._best(records)
+        self.best_index_ = records.index(best)
+        self.best_params_ = best['params']
+        self.best_score_ = np.mean(best['scores'])
+        logging.info('best of {} candidates scored {:.4f}: {}'.format(
+            len(records), self.best_score_, self.best_params_))
+
+        if self.refit:
+            self.best_estimator_ = clone(self.estimator).set_params(
+                **self.best_params_).fit(X, y)
+        return self
+
+    def _best(self, records):
+        return max(records, key = lambda record: np.mean(record['scores']))
+
+    def _parallel(self, tasks):
+        return Parallel(n_jobs = self.n_jobs, verbose = self.verbose)(tasks)
+
+    def _results(self, records):
+        scores = np.array([record['scores'] for record in records])
+        means = scores.mean(axis = 1)
+        results = {'params': [record['params'] for record in records],
+            'mean_test_score': means,
+            'std_test_score': scores.std(axis = 1),
+            'rank_test_score': (len(means)
+                - np.argsort(np.argsort(means, kind = 'mergesort'))
+                ).astype(int)}
+        for i in range(scores.shape[1]):
+            results['split{}_test_score'.format(i)] = scores[:, i]
+        names = sorted(set(name for record in records
+            for name in record['params']))
+        for name in names:
+            results['param_{}'.format(name)] = np.ma.masked_array(
+                [record['params'].get(name) for record in records],
+                mask = [name not in record['params'] for record in records],
+                dtype = object)
+        for key in records[0].get('extra', dict()):
+            results[key] = np.array([record['extra'][key]
+                for record in records])
+        return results
+
+    @property
+    def classes_(self):
+        return self.best_estimator_.classes_
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def score(self, X, y = None):
+        return self.scorer_(self.best_estimator_, X, y)
+
+
+class SuccessiveHalvingSearch(BaseIncrementalSearch):
+    """Search that evaluates every candidate with a small resource (training
+    rows per fold, or a parameter such as the number of trees), keeps the
+    best 1/factor of them and repeats with factor times the resource until
+    one candidate is left or the resource reaches its maximum. Cheap early
+    rounds prune losing candidates, so the cost follows the number of good
+    candidates rather than the size of the grid.
+    Args:
+        resource (str): 'n_samples' or the name of an integer parameter
+        factor (int): how many times fewer candidates, and how many times more
+            resource, in each round
+        min_resources (int): resource of the first round, chosen so the last
+            round ends with a single candidate at max_resources if None
+        max_resources (int): largest resource, the training rows of the
+            smallest fold for 'n_samples' (required for a parameter)
+        n_candidates (int): sample this many candidates from the grid instead
+            of trying all of them
+    """
+    def __init__(self, estimator, param_grid, scoring = None, cv = 5,
+            n_jobs = None, refit = True, verbose = 0, random_state = None,
+            resource = 'n_samples', factor = 3, min_resources = None,
+            max_resources = None, n_candidates = None):
+        super(SuccessiveHalvingSearch, self).__init__(estimator, param_grid,
+            scoring = scoring, cv = cv, n_jobs = n_jobs, refit = refit,
+            verbose = verbose, random_state = random_state)
+        self.resource = resource
+        self.factor = factor
+        self.min_resources = min_resources
+        self.max_resources = max_resources
+        self.n_candidates = n_candidates
+
+    def _search(self, X, y, splits):
+        # the resource is set by each round, not searched over
+        param_grid = dict((name, values)
+            for name, values in self.param_grid.items()
+            if name != self.resource)
+        if self.n_candidates:
+            candidates = list(ParameterSampler(param_grid,
+                self.n_candidates, random_state = self.random_state))
+        else:
+            candidates = list(ParameterGrid(param_grid))
+
+        by_samples = self.resource == 'n_samples'
+        max_resources = self.max_resources
+        if by_samples:
+            smallest = min(len(train) for train, _ in splits)
+            max_resources = min(max_resources or smallest, smallest)
+            # a fixed random order, so each round trains on a superset, and
+            # stratified, so even the smallest round sees every class
+            rng = np.random.RandomState(self.random_state)
+            splits = [(_stratified_order(y, train, rng), test)
+                for train, test in splits]
+        elif max_resources is None:
+            raise ValueError('max_resources is required when the resource '
+                'is {}'.format(self.resource))
+        n_rounds = int(math.ceil(math.log(len(candidates), self.factor))) + 1
+        resources = self.min_resources or max(1,
+            max_resources // self.factor ** (n_rounds - 1))
+
+        records = []
+        i = 0
+        while True:
+            resources = min(resources, max_resources)
+            if by_samples:
+                round_params = candidates
+                tasks = (delayed(_fit_and_score)(self.estimator, params,
+                    X, y, train[:resources], test, self.scorer_)
+                    for params in round_params for train, test in splits)
+            else:
+                round_params = [dict(params, **{self.resource: resources})
+                    for params in candidates]
+                tasks = (delayed(_fit_and_score)(self.estimator, params,
+                    X, y, train, test, self.scorer_)
+                    for params in round_params for train, test in splits)
+            scores = np.array(self._parallel(tasks)).reshape(
+                len(candidates), len(splits))
+            records.extend({'params': params, 'scores': list(fold_scores),
+                'extra': {'iter': i, 'n_resources': resources}}
+                for params, fold_scores in zip(round_params, scores))
+            logging.info('halving round {}: {} candidates with {} {}'.format(
+                i, len(candidates), resources, self.resource))
+
+            if len(candidates) == 1 or resources >= max_resources:
+                break
+            n_keep = int(math.ceil(len(candidates) / float(self.factor)))
+            order = np.argsort(-scores.mean(axis = 1), kind = 'mergesort')
+            candidates = [candidates[j] for j in order[:n_keep]]
+            resources *= self.factor
+            i += 1
+
+        self.n_rounds_ = i + 1
+        return records
+
+    def _best(self, records):
+        # only the last round saw the candidates at the full resource
+        last = [record for record in records
+            if record['extra']['iter'] == self.n_rounds_ - 1]
+        return max(last, key = lambda record: np.mean(record['scores']))
+
+
+class WarmStartForestSearch(BaseIncrementalSearch):
+    """Exhaustive search over a grid listing several forest sizes. For each
+    fold and each combination of the other parameters, one forest is grown
+    with warm start from the smallest to the largest size and scored at
+    every size on the way, so the sizes cost about as much as the largest
+    forest alone. Each size is reported as its own candidate in cv_results_.
+    Only the size changes while a forest grows, the other parameters being
+    fixed per combination, so with an integer random_state on the forest
+    every size scores exactly as a forest fitted from scratch would.
+    Args:
+        n_estimators_param (str): the name of the forest size parameter
+    """
+    def __init__(self, estimator, param_grid, scoring = None, cv = 5,
+            n_jobs = None, refit = True, verbose = 0, random_state = None,
+            n_estimators_param = N_ESTIMATORS):
+        super(WarmStartForestSearch, self).__init__(estimator, param_grid,
+            scoring = scoring, cv = cv, n_jobs = n_jobs, refit = refit,
+            verbose = verbose, random_state = random_state)
+        self.n_estimators_param = n_estimators_param
+
+    def _search(self, X, y, splits):
+        n_estimators = sorted(self.param_grid[self.n_estimators_param])
+        groups = list(ParameterGrid(dict((name, values)
+            for name, values in self.param_grid.items()
+            if name != self.n_estimators_param)))
+        tasks = (delayed(_grow_and_score)(self.estimator, params,
+            n_estimators, X, y, train, test, self.scorer_)
+            for params in groups for train, test in splits)
+        # groups x folds x sizes
+        scores = np.array(self._parallel(tasks)).reshape(
+            len(groups), len(splits), len(n_estimators))
+        self.n_preprocessing_fits_ = len(groups) * len(splits) + 1
+        logging.info('{} forests grown to {} sizes for {} folds'.format(
+            len(groups), len(n_estimators), len(splits)))
+        return [{'params': dict(params, **{self.n_estimators_param: size}),
+                'scores': list(scores[i, :, j])}
+            for i, params in enumerate(groups)
+            for j, size in enumerate(n_estimators)]
+
+
+def make_search(pipeline, param_grid, search_opts, scoring, n_jobs = -1,
+        cv = None):
+    """Build the hyperparameter search chosen by the search section of the
+    grid options file.
+    Args:
+        pipeline (sklearn.Pipeline): the pipeline to tune
+        param_grid (dict): parameter options by pipeline parameter name
+        search_opts (dict): the search options, see
+            pipeline_tools.build_search_options
+        scoring (str): the scoring used to compare candidates
+        n_jobs (int): number of fits run at once
+        cv: a splitter or list of folds overriding the cv search option
+    Returns:
+        a search object with fit, predict_proba, best_estimator_ and cv_results_
+    """
+    strategy = search_opts['strategy']
+    if strategy not in STRATEGIES:
+        raise ValueError('unknown search strategy {}, expected one of '
+            '{}'.format(strategy, ', '.join(STRATEGIES)))
+    cv = cv or search_opts['cv']
+    # grown forests only match fresh ones when the trees are seeded the same
+    seeds = param_grid.get(RANDOM_STATE,
+        [pipeline.get_params().get(RANDOM_STATE)])
+    seeded = all(isinstance(seed, numbers.Integral) for seed in seeds)
+    warm_start = (search_opts.get('warm_start', True) and seeded
+        and len(param_grid.get(N_ESTIMATORS, [])) > 1)
+    if strategy == 'exhaustive' and warm_start:
+        return WarmStartForestSearch(pipeline, param_grid, scoring = scoring,
+            cv = cv, n_jobs = n_jobs, verbose = 1)
+    if strategy == 'exhaustive':
+        return GridSearchCV(pipeline, n_jobs = n_jobs, cv = cv,
+            param_grid = param_grid, scoring = scoring,
+            # verbose output suppressed during multiprocessing
+            verbose = 1) # show folds and model fits as they complete
+    if strategy == 'randomized':
+        return RandomizedSearchCV(pipeline, n_jobs = n_jobs, cv = cv,
+            param_distributions = param_grid, scoring = scoring,
+            n_iter = search_opts['budget'],
+            random_state = search_opts.get('random_state'), verbose = 1)
+    return SuccessiveHalvingSearch(pipeline, param_grid, scoring = scoring,
+        cv = cv, n_jobs = n_jobs, random_state = search_opts.get('random_state'),
+        resource = search_opts.get('resource', 'n_samples'),
+        factor = search_opts.get('factor', 3),
+        min_resources = search_opts.get('min_resources'),
+        max_resources = search_opts.get('max_resources'),
+        n_candidates = search_opts.get('budget'))
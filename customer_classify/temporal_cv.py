@@ -1,37 +1,261 @@
 from datetime import datetime, timedelta
 from s3_read_write import S3ReadWrite
+from sklearn.preprocessing import LabelBinarizer
+import pandas as pd
+import numpy as np
+import os, json, logging
 
 def read_data(end_date, n_folds, offset,
-    input_s3, input_csv_path, output_s3, output_csv_path):
+    input_s3, input_csv_path, output_s3, output_csv_path,
+    columns = None, filters = None):
+    """Read the dated input snapshots and outcome labels of every fold,
+    fetching only the requested columns and rows of each snapshot.
+    Args:
+        columns (list[str]): input columns to read, all columns if None
+        filters (list[tuple]): (column, op, value) conditions on input rows
+    Returns:
+        tuple(pandas.DataFrame): input and output data indexed by
+            internal_user_id and input_date
+    """
 
     date_fmt = '%Y-%m-%d'
     end_date = datetime.strptime(end_date, date_fmt)
     dates = [(end_date - timedelta(days = offset * i)
             ).strftime(date_fmt)
         for i in range(n_folds)]
+    if columns is not None and 'internal_user_id' not in columns:
+        columns = ['internal_user_id'] + list(columns)
 
-    input_data = [(input_s3.read_from_S3_csv(
-            csv_path = input_csv_path,
-            csv_name = date)
+    input_data = {date: (data
         .assign(input_date = date)
         .set_index(['internal_user_id', 'input_date']))
-        for date in dates]
+        for date, data in input_s3.read_many(input_csv_path, dates,
+            reader = input_s3.read_columns,
+            columns = columns, filters = filters)}
 
-    output_data = [(output_s3.read_from_S3_csv(
-            csv_path = output_csv_path,
-            csv_name = date)
+    output_data = {date: (data
         .assign(input_date = date)
         .set_index(['internal_user_id', 'input_date']))
-        for date in dates]
+        for date, data in output_s3.read_many(output_csv_path, dates,
+            reader = output_s3.read_columns,
+            columns = ['internal_user_id', 'canceled'])}
 
-    return pd.concat(input_data), pd.concat(output_data)
+    return (pd.concat([input_data[date] for date in dates]),
+        pd.concat([output_data[date] for date in dates]))
+
+
+class TemporalSplit(object):
+    """A cross-validation splitter that validates on each date using only
+    rows from earlier dates, for data indexed by a date level such as
+    input_date. Training dates must be at least gap before the validation
+    date, e.g. the outcome offset, so no training label comes from after
+    the validation inputs. Training windows either expand to every earlier
+    date or slide over the latest train_dates of them. Index arrays are
+    built once per date and reused for every fold.
+
+    Usage:
+        cv = TemporalSplit(n_splits = 3, gap = 7)
+        GridSearchCV(pipeline, param_grid, cv = cv).fit(X, y)
+    """
+    def __init__(self, n_splits = None, window = 'expanding',
+            train_dates = None, gap = 7, date_level = 'input_date'):
+        if window not in ('expanding', 'sliding'):
+            raise ValueError('window must be expanding or sliding')
+        if window == 'sliding' and not train_dates:
+            raise ValueError('a sliding window needs train_dates')
+        self.n_splits = n_splits
+        self.window = window
+        self.train_dates = train_dates
+        self.gap = gap
+        self.date_level = date_level
+
+    def __repr__(self):
+        return ('TemporalSplit(n_splits={}, window={}, train_dates={}, '
+            'gap={}, date_level={})').format(self.n_splits, self.window,
+            self.train_dates, self.gap, self.date_level)
+
+    def folds(self, X, groups = None):
+        """Compute the folds of a dataset.
+        Args:
+            X (Pandas.DataFrame): data with the date level in its index
+            groups (array): the date of each row, instead of the index level
+        Returns:
+            list[tuple]: validation date, train and validation row positions
+        """
+        if groups is None and self.date_level not in X.index.names:
+            raise ValueError('no {} index level to split on, the index has '
+                '{}'.format(self.date_level, ', '.join(map(str,
+                    X.index.names))))
+        dates = (X.index.get_level_values(self.date_level)
+            if groups is None else groups)
+        unique, codes = np.unique(np.asarray(dates), return_inverse = True)
+        if unique.dtype.kind in 'iuf':
+            points, gap = unique, self.gap
+        else:
+            points = pd.to_datetime(unique)
+            gap = pd.Timedelta(days = self.gap)
+        order = np.argsort(codes, kind = 'mergesort')
+        bounds = np.cumsum(np.bincount(codes, minlength = len(unique)))
+        positions = np.split(order, bounds[:-1])
+
+        folds = []
+        for v in range(len(unique)):
+            train = [d for d in range(v) if points[d] <= points[v] - gap]
+            if self.window == 'sliding':
+                train = train[-self.train_dates:]
+            if train:
+                folds.append((unique[v],
+                    np.sort(np.concatenate([positions[d] for d in train])),
+                    positions[v]))
+        if self.n_splits:
+            if len(folds) < self.n_splits:
+                raise ValueError('only {} dates can be validated with a gap '
+                    'of {}'.format(len(folds), self.gap))
+            folds = folds[-self.n_splits:]
+        return folds
+
+    def split(self, X, y = None, groups = None):
+        for _, train, test in self.folds(X, groups):
+            yield train, test
+
+    def get_n_splits(self, X = None, y = None, groups = None):
+        if self.n_splits:
+            return self.n_splits
+        return len(self.folds(X, groups))
+
+
+def split_holdout(model_matrix, folds, outcome_name = 'outcome',
+        n_splits = None):
+    """Split a model matrix with temporal folds into training rows and a
+    holdout, in place of a random train/test split: the validation rows of
+    the last fold are held out and its training rows are the training set,
+    so no training label comes from after the holdout inputs. The earlier
+    folds lying entirely within the training rows are kept, renumbered as
+    positions in the training set, to validate the search on.
+    Args:
+        model_matrix (Pandas.DataFrame): data containing features and outcome
+        folds (list[tuple(numpy.ndarray)]): train and validation row
+            positions in model_matrix, oldest validation date first (see
+            TemporalSplit.folds and FoldStore.load)
+        outcome_name (str): name of column containing outcome variable
+        n_splits (int): keep only this many of the latest folds
+    Returns:
+        Pandas.DataFrame: training features
+        Pandas.DataFrame: holdout features
+        numpy.ndarray: training target labels (if multiclass, a column for each class)
+        numpy.ndarray: holdout target labels (if multiclass, a column for each class)
+        sklearn.LabelBinarizer: transforms multiclass labels into binary dummies
+        list[tuple(numpy.ndarray)]: train and validation positions in the
+            training features
+    """
+    train, holdout = folds[-1]
+    position = np.full(len(model_matrix), -1)
+    position[train] = np.arange(len(train))
+    inner = [(position[t], position[v]) for t, v in folds[:-1]
+        if (position[t] >= 0).all() and (position[v] >= 0).all()]
+    if n_splits:
+        inner = inner[-n_splits:]
+    if len(inner) < (n_splits or 1):
+        raise ValueError('only {} folds validate before the holdout, need '
+            '{}'.format(len(inner), n_splits or 1))
+
+    X, y = model_matrix.drop(outcome_name, axis = 1), model_matrix[outcome_name]
+    lb = LabelBinarizer().fit(y.iloc[train])
+    logging.info('{} training rows in {} folds, {} rows held out'.format(
+        len(train), len(inner), len(holdout)))
+    return (X.iloc[train], X.iloc[holdout],
+        lb.transform(y.iloc[train]).squeeze(),
+        lb.transform(y.iloc[holdout]).squeeze(), lb, inner)
+
+
+class FoldStore(object):
+    """A local store of a temporal CV dataset: the concatenated model matrix
+    written once as Parquet, with the train and validation row positions of
+    every fold, so grid searches, evaluation and reruns reuse them without
+    reading the snapshots from S3 again.
+
+    Usage:
+        store = FoldStore('~/.cache/customer_propensity/folds/canceled_7')
+        if not store.exists():
+            store.save(read_matrix(), TemporalSplit(gap = 7))
+        data, folds = store.load()
+        GridSearchCV(pipeline, param_grid, cv = folds)
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return all(os.path.exists(self._file(name))
+            for name in ('matrix.parquet', 'folds.npz', 'meta.json'))
+
+    def save(self, data, splitter, description = None):
+        """Write the matrix and the folds the splitter makes of it.
+        Args:
+            data (Pandas.DataFrame): the model matrix
+            splitter (TemporalSplit): the splitter defining the folds
+            description (dict): how the matrix was built, kept for reference
+        """
+        os.makedirs(self.path, exist_ok = True)
+        folds = splitter.folds(data)
+        data.to_parquet(self._file('matrix.parquet'))
+        arrays = dict()
+        for i, (_, train, test) in enumerate(folds):
+            arrays['train_{}'.format(i)] = train
+            arrays['test_{}'.format(i)] = test
+        np.savez(self._file('folds.npz'), **arrays)
+        with open(self._file('meta.json'), 'w') as f:
+            json.dump({'splitter': repr(splitter), 'description': description,
+                'validation_dates': [str(date) for date, _, _ in folds],
+                'rows': len(data)}, f)
+        logging.info('{} rows and {} folds stored in {}'.format(
+            len(data), len(folds), self.path))
+
+    def load(self):
+        """Read the matrix and its folds.
+        Returns:
+            Pandas.DataFrame: the model matrix
+            list[tuple(numpy.ndarray)]: train and validation row positions of
+                each fold, usable as the cv of a search
+        """
+        data = pd.read_parquet(self._file('matrix.parquet'))
+        with np.load(self._file('folds.npz')) as arrays:
+            folds = [(arrays['train_{}'.format(i)], arrays['test_{}'.format(i)])
+                for i in range(len(arrays.files) // 2)]
+        return data, folds
+
+
+def build_fold_store(store, end_date, n_folds, offset, input_s3,
+        input_csv_path, output_s3, output_csv_path, window = 'expanding',
+        train_dates = None, refresh = False, **read_kwargs):
+    """Load a temporal CV dataset from its fold store, reading the snapshots
+    and labels from S3 and storing them only the first time.
+    Returns:
+        Pandas.DataFrame: the inputs joined with their outcome labels
+        list[tuple(numpy.ndarray)]: train and validation row positions
+    """
+    if refresh or not store.exists():
+        input_data, output_data = read_data(end_date, n_folds, offset,
+            input_s3, input_csv_path, output_s3, output_csv_path,
+            **read_kwargs)
+        data = input_data.join(output_data, how = 'inner')
+        store.save(data, TemporalSplit(window = window,
+                train_dates = train_dates, gap = offset),
+            description = {'end_date': end_date, 'n_folds': n_folds,
+                'offset': offset, 'input': input_csv_path,
+                'output': output_csv_path})
+    return store.load()
 
 
 def main():
     input_s3 = S3ReadWrite('plated-data-science', 'sample_input_data')
     output_s3 = S3ReadWrite('plated-data-science', 'sample_output_data')
 
-    input_data, output_data = read_data(
+    data, folds = build_fold_store(
+        FoldStore(os.path.join('~', '.cache', 'customer_propensity', 'folds',
+            'canceled_within_7_days')),
         end_date = '2018-01-21', n_folds = 5, offset = 7,
         input_s3 = input_s3, input_csv_path = 'ETLV_v2',
         output_s3 = output_s3, output_csv_path = 'canceled_within_7_days')
@@ -1,43 +1,32 @@
 from s3_read_write import S3ReadWrite
-import pandas as pd
-from datetime import datetime, timedelta
-
-date_fmt = '%Y-%m-%d'
-s3_input = S3ReadWrite('plated-data-science', 'sample_input_data')
-s3_output = S3ReadWrite('plated-data-science', 'sample_output_data')
-input_folder = 'ETLV_v2'
-x0 = datetime.strptime('2018-01-28', date_fmt)
-
-n_folds = 12
-offset = 7
-outcome_dates = [x0 - timedelta(days = offset * i)
-                for i in range(n_folds)]
-
-input_dates = [outcome - timedelta(days = offset)
-            for outcome in outcome_dates]
-
-folds = [(a.strftime(date_fmt), b.strftime(date_fmt))
-            for a,b in zip(input_dates, outcome_dates)]
-
-all_dates = set(x[0] for x in folds).union(set(x[1] for x in folds))
-
-data = {date: s3_input.read_from_S3_csv(
-    csv_path = 'ETLV_v2',
-    csv_name = date,
-    usecols = ['internal_user_id'])
-    for date in all_dates}
-
-def build_output(input_date, output_date):
-    input = data[input_date]
-    output = data[output_date]
-    input['canceled'] = ~input.internal_user_id.isin(
-        output.internal_user_id)
-    return input
-
-output = {date1: build_output(date1, date2)
-    for date1, date2 in folds}
-
-[s3_output.put_dataframe_to_S3(
-    'canceled_within_{}_days'.format(offset),
-    date, outcome_data)
-    for date, outcome_data in output.items()]
+from customer_classify.outcome_labels import write_labels
+from argparse import ArgumentParser
+import logging
+
+
+def main(args):
+    logging.basicConfig(level = logging.INFO)
+    s3_input = S3ReadWrite('plated-data-science', 'sample_input_data')
+    s3_output = S3ReadWrite('plated-data-science', 'sample_output_data')
+
+    write_labels(s3_input, s3_output, input_path = 'ETLV_v2',
+        end_date = args.outcome_date, n_folds = args.n_folds,
+        offsets = args.offsets, step = args.step,
+        max_workers = args.max_workers)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Build cancellation labels from dated snapshots')
+    parser.add_argument('--outcome_date', default = '2018-01-28',
+        help = 'latest outcome date YYYY-MM-DD')
+    parser.add_argument('--n_folds', type = int, default = 12,
+        help = 'number of folds per horizon')
+    parser.add_argument('--offsets', type = int, nargs = '+', default = [7],
+        help = 'cancellation horizons in days, e.g. 7 14 28')
+    parser.add_argument('--step', type = int,
+        help = 'days between folds, the smallest offset by default')
+    parser.add_argument('--max_workers', type = int, default = 8,
+        help = 'number of snapshots read or labelled at once')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,72 @@
+-- Eligible subscribers for every fold in one pass: for each fold end date in
+-- the fold_windows table, subscribers with an active subscription at the end
+-- date of the input time period who have received at least 1 box by then.
+-- Same rules as active_eligibility.sql, evaluated for all folds at once.
+WITH ranked_events AS (
+  SELECT w.fold_end_date
+  , u.internal_user_id
+  , u.subscription_status_change_event
+  , ROW_NUMBER() OVER (
+      PARTITION BY w.fold_end_date, u.internal_user_id
+      ORDER BY u.subscription_changed_at DESC)
+    AS recency
+  FROM fold_windows w
+    INNER JOIN dw.user_subscription_events u
+      ON DATE(u.subscription_changed_at) <= w.fold_end_date
+),
+actives AS (
+  SELECT fold_end_date
+  , internal_user_id
+  FROM ranked_events
+  WHERE recency = 1
+    AND subscription_status_change_event <> 'cancelation'
+),
+subscription_activated AS (
+  SELECT u.internal_user_id
+  , DATE(convert_timezone('America/New_York', source_created_at))
+    AS join_date
+  , email like '%@plated.com' AS plated_email
+  FROM dw.users u
+  WHERE u.internal_user_id IN (SELECT internal_user_id FROM actives)
+),
+boxes_ordered AS (
+  SELECT a.fold_end_date
+  , a.internal_user_id
+  , max(nth_delivery)
+    AS n_boxes_delivered
+  FROM actives a
+  INNER JOIN dw.menu_order_boxes b
+    ON a.internal_user_id = b.internal_user_id
+    AND status = 'shipped'
+    AND delivery_date <= a.fold_end_date
+  GROUP BY 1, 2
+),
+employee AS (
+  SELECT user_id
+  , min(DATE(discounts.created_at))
+    AS employee_since
+  FROM web.users_discounts ud
+  INNER JOIN web.discounts
+    ON discount_id = discounts.id
+  INNER JOIN web.discount_categories dc
+    ON discount_category_id = dc.id
+    AND dc.name IN ('corporate', 'employee')
+  GROUP BY 1
+)
+SELECT a.fold_end_date
+  , a.internal_user_id
+  , DATEDIFF(week, s.join_date, a.fold_end_date)
+    AS weeks_since_activation
+  , n_boxes_delivered
+FROM actives a
+  LEFT JOIN subscription_activated s
+    ON a.internal_user_id = s.internal_user_id
+  LEFT JOIN boxes_ordered bo
+    ON a.fold_end_date = bo.fold_end_date
+    AND a.internal_user_id = bo.internal_user_id
+  LEFT JOIN employee e
+    ON a.internal_user_id = e.user_id
+    AND e.employee_since <= a.fold_end_date
+WHERE e.user_id IS null
+  AND NOT s.plated_email
+  AND n_boxes_delivered IS NOT NULL
@@ -1,53 +1,168 @@
 from sqlalchemy import create_engine, text
 import logging, re, sys
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 from upload_customer_lists import upload_eligible_subscribers
+from customer_classify.aggregation import (PartialAggregates,
+    aggregation_spec, assign_folds)
+from feature_etl_specify import state_trait_event_convert
+from feature_etl_specify.state_trait_event_convert import SlidingWindowFeatures
+from s3_read_write import S3ReadWrite
 import pandas as pd
 
 
-def split_and_aggregate(data):
-    # features to take the sum of
-    sum_features = []
+# features to take the sum of
+sum_features = []
 
-    # features to take the average of
-    average_features = []
+# features to take the average of
+average_features = []
 
-    # features to take the max value
-    max_features = []
+# features to take the max value
+max_features = []
 
-    # features to take the min value
-    min_features = []
+# features to take the min value
+min_features = []
 
-    # features to determine if any are true
-    any_features = []
+# features to determine if any are true
+any_features = []
 
-    # features to determine if all are true
-    all_features = []
+# features to determine if all are true
+all_features = []
 
 
-def eligible_users_by_fold(query_file, input_dates, connection):
+def feature_spec():
+    return aggregation_spec(sum = sum_features, mean = average_features,
+        max = max_features, min = min_features,
+        any = any_features, all = all_features)
+
+
+def split_and_aggregate(chunks, input_dates, spec = None,
+        date_col = 'event_date'):
+    """Aggregate unaggregated feature rows per fold and user. Each chunk is
+    split into the fold windows containing its rows and reduced in one
+    grouped pass, so the rows never have to fit in memory at once.
+    Args:
+        chunks (iterable[Pandas.DataFrame]): rows of the feature extract with
+            internal_user_id, the date column and the columns of the spec
+        input_dates (list[tuple(datetime)]): (start, end) of each input period
+        spec (dict(list[str])): aggregations by column, feature_spec() if None
+        date_col (str): the column holding the date of each row
+    Returns:
+        Pandas.DataFrame: aggregated features indexed by fold_end_date and
+            internal_user_id
+    """
+    aggregates = PartialAggregates(spec or feature_spec(),
+        keys = ['fold_end_date', 'internal_user_id'])
+    for chunk in chunks:
+        aggregates.update(assign_folds(chunk, input_dates, date_col))
+    return aggregates.result()
+
+
+def sliding_window_aggregate(chunks, outcome_date, n_folds, offset,
+        input_width, date_col = 'event_date'):
+    """Aggregate unaggregated feature rows per fold and user with the state,
+    trait and event columns of state_trait_event_convert, reducing the rows
+    once to time buckets shared by all the overlapping fold windows.
+    Args:
+        chunks (iterable[Pandas.DataFrame]): rows of the feature extract
+        outcome_date (datetime): latest outcome date
+        n_folds (int): number of fold windows
+        offset (int): delay between input data and outcome in days, which is
+            also the shift between consecutive folds
+        input_width (int): interval width of input data in days
+        date_col (str): the column holding the date of each row
+    Returns:
+        Pandas.DataFrame: features indexed by fold_end_date and
+            internal_user_id
+    """
+    windows = SlidingWindowFeatures(
+        outcome_date - timedelta(days = offset), n_folds, offset, input_width,
+        state_cols = state_trait_event_convert.state_cols,
+        trait_cols = state_trait_event_convert.trait_cols,
+        event_cols = state_trait_event_convert.event_cols,
+        date_col = date_col)
+    for chunk in chunks:
+        windows.update(chunk)
+    return windows.result()
+
+
+def eligible_users_by_fold(query_file, input_dates, connection,
+        max_workers = 4):
+    """Run the eligibility query once per fold, with up to max_workers folds
+    in flight on the engine's connection pool.
+    Args:
+        query_file (str): path to the eligibility query, taking :end_date
+        input_dates (list[tuple(datetime)]): (start, end) of each input period
+        connection (sqlalchemy.engine.Engine): the database engine
+        max_workers (int): maximum number of folds queried at once
+    Returns:
+        tuple(Pandas.DataFrame): eligible users indexed by fold_end_date and
+            internal_user_id, and the distinct eligible users of all folds
+    """
     query = text(open(query_file).read())
-    eligible_users = [pd.read_sql(query, connection,
-        params = {'start_date_input': dates[0],
-                  'end_date_input': dates[1]},
-        index_col = 'internal_user_id')
-        for dates in input_dates]
+
+    def eligible_users(dates):
+        return pd.read_sql(query, connection,
+            params = {'start_date_input': dates[0],
+                      'end_date_input': dates[1],
+                      'end_date': dates[1]},
+            index_col = 'internal_user_id')
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        eligible_users = list(executor.map(eligible_users, input_dates))
     logging.info('eligible users found for {} folds'.format(
         len(eligible_users)))
 
     eligible_users = pd.concat(eligible_users,
-        keys = [dates[1] for dates in input_dates],
+        keys = [pd.Timestamp(dates[1]) for dates in input_dates],
         names = ['fold_end_date', 'internal_user_id'])
 
+    return eligible_users, distinct_users(eligible_users)
+
+
+def eligible_users_all_folds(query_file, input_dates, connection):
+    """Run a windowed eligibility query once for all folds. The end dates of
+    the folds are loaded into a temporary fold_windows table which the query
+    joins against, so the warehouse scans the source tables a single time.
+    Args:
+        query_file (str): path to the windowed eligibility query returning
+            fold_end_date and internal_user_id
+        input_dates (list[tuple(datetime)]): (start, end) of each input period
+        connection (sqlalchemy.engine.Engine): the database engine
+    Returns:
+        tuple(Pandas.DataFrame): eligible users indexed by fold_end_date and
+            internal_user_id, and the distinct eligible users of all folds
+    """
+    query = text(open(query_file).read())
+    # temporary tables only live in the session that created them
+    with connection.connect() as session:
+        session.execute(text(
+            'create temporary table fold_windows (fold_end_date date)'))
+        session.execute(text(
+            'insert into fold_windows (fold_end_date) values (:fold_end_date)'),
+            [{'fold_end_date': dates[1].date()} for dates in input_dates])
+        eligible_users = pd.read_sql(query, session)
+        session.execute(text('drop table fold_windows'))
+    logging.info('eligible users found for {} folds in one query'.format(
+        len(input_dates)))
+
+    eligible_users['fold_end_date'] = pd.to_datetime(
+        eligible_users.fold_end_date)
+    eligible_users = eligible_users.set_index(
+        ['fold_end_date', 'internal_user_id']).sort_index()
+
+    return eligible_users, distinct_users(eligible_users)
+
+
+def distinct_users(eligible_users):
     all_eligible_users = (eligible_users.index
         .get_level_values('internal_user_id')
         .unique()
         .to_frame())
     logging.info('{} distinct eligible users found across all folds'.format(
         all_eligible_users.shape[0]))
-
-    return eligible_users, all_eligible_users
+    return all_eligible_users
 
 
 def main(args):
@@ -78,22 +193,53 @@ def main(args):
           driver = "postgresql+psycopg2",
           host = "localhost",
           port = 5439,
-          dbname = "production"))
+          dbname = "production"),
+        pool_size = args.max_workers)
     logging.info('database connection initialized')
 
-    users_by_fold, all_users = eligible_users_by_fold(
-        args.eligibility, input_dates, connection)
+    if args.eligibility_windows:
+        users_by_fold, all_users = eligible_users_all_folds(
+            args.eligibility_windows, input_dates, connection)
+    else:
+        users_by_fold, all_users = eligible_users_by_fold(
+            args.eligibility, input_dates, connection,
+            max_workers = args.max_workers)
     logging.info('eligible subscribers for model training and validation pulled')
 
     upload_eligible_subscribers(all_users, connection,
         str(start_date.date()), str(end_date.date()))
     logging.info('eligible subscribers uploaded to database')
 
+    if args.feature_extract:
+        with connection.connect() as session:
+            chunks = pd.read_sql(text(open(args.feature_extract).read()),
+                session.execution_options(stream_results = True),
+                params = {'start_date': start_date, 'end_date': end_date},
+                chunksize = args.chunksize)
+            if args.sliding_windows:
+                features = sliding_window_aggregate(chunks, args.outcome_date,
+                    len(input_dates), args.offset, args.input_width)
+            else:
+                features = split_and_aggregate(chunks, input_dates)
+        features = features.join(users_by_fold[[]], how = 'inner')
+        logging.info('features aggregated for {} users and folds'.format(
+            len(features)))
+
+        s3_writer = S3ReadWrite(bucket = 'plated-data-science',
+            folder = 'sample_input_data')
+        s3_writer.put_dataframe_to_S3(csv_path = 'aggregated_features',
+            csv_name = str(end_date.date()),
+            dataframe = features.reset_index())
+        logging.info('aggregated features saved')
+
 
 if __name__ == '__main__':
     parser = ArgumentParser('Extract data for training and validating propensity model')
     parser.add_argument('--eligibility',
         help = 'path to sql query defining customer eligibility')
+    parser.add_argument('--eligibility_windows',
+        help = 'path to sql query defining customer eligibility for all '
+            'folds at once; runs --eligibility per fold if not given')
     parser.add_argument('--feature_extract',
         help = 'path to sql query extracting unaggregated input features')
     parser.add_argument('--outcome',
@@ -117,6 +263,15 @@ if __name__ == '__main__':
     parser.add_argument('--n_folds', type = int,
         help = 'number of folds for temporal CV',
         default = 10)
+    parser.add_argument('--sliding_windows', action = 'store_true',
+        help = 'aggregate the state, trait and event columns of '
+            'state_trait_event_convert incrementally across folds')
+    parser.add_argument('--chunksize', type = int,
+        help = 'rows of the feature extract aggregated at a time',
+        default = 100000)
+    parser.add_argument('--max_workers', type = int,
+        help = 'number of folds queried at once without --eligibility_windows',
+        default = 4)
 
     args = parser.parse_args()
     main(args)
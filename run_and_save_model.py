@@ -1,4 +1,7 @@
-from customer_classify import model_data, pipeline_tools, reporting
+from customer_classify import model_data, pipeline_tools, reporting, search
+from customer_classify.temporal_cv import (TemporalSplit, FoldStore,
+    split_holdout)
+from customer_classify.feature_cache import FeatureCache
 
 import re, os, sys, logging
 import pandas as pd
@@ -6,14 +9,15 @@ import numpy as np
 
 from sklearn.pipeline import make_pipeline
 from sklearn import ensemble, feature_selection, preprocessing
-from sklearn.model_selection import RandomizedSearchCV
 from argparse import ArgumentParser
 
 
 def fit_pipeline(model_matrix, grid_path, pkldir,
     alg_id = 'debug', alg_name = 'screening_rf',
     scoring = 'roc_auc', # 'f1_micro',
-    write_predictions = True, path = None, group = None):
+    write_predictions = True, path = None, group = None, batch_size = 50000,
+    preprocess_cache = None, search_opts = None, cv = None,
+    outcome_name = 'outcome'):
     """Train a new model over a grid search and optionally write train and test
     set predictions to the database.
     Args:
@@ -33,6 +37,19 @@ def fit_pipeline(model_matrix, grid_path, pkldir,
         path (str): credentials path to reconnect to the database in order to
             output predictions on train and test set
         group (str): credentials group to reconnect to the database
+        batch_size (int): number of prediction rows written per batch
+        preprocess_cache (PreprocessingCache): a store for the fitted
+            preprocessing steps, so each fold's preprocessing is fitted once
+            for all classifier candidates; no caching if None
+        search_opts (dict): how to search the grid, read from the search
+            section of the grid options file if None
+        cv: a TemporalSplit or list of temporal (train, validation) row
+            positions in the model matrix, e.g. from a FoldStore, in which
+            case the last validation date is held out for testing and the
+            search validates on the earlier folds; a TemporalSplit if the
+            search options have a temporal section, else a random holdout
+            and the cv search option, if None
+        outcome_name (str): name of the column holding the outcome
     Returns:
         (GridSearchCV, LabelBinarizer)
     """
@@ -40,20 +57,47 @@ def fit_pipeline(model_matrix, grid_path, pkldir,
     pipeline = make_pipeline(pipeline_tools.DummyEncoder(),
             preprocessing.Imputer(),
             feature_selection.VarianceThreshold(),
-            ensemble.RandomForestClassifier(random_state = 1100))
+            ensemble.RandomForestClassifier(random_state = 1100),
+            memory = preprocess_cache and preprocess_cache.memory)
     param_grid = pipeline_tools.build_param_grid(pipeline, grid_path)
-    grid_search = GridSearchCV(pipeline, n_jobs = -1, cv = 5,
-        param_grid = param_grid, scoring = scoring,
-        # verbose output suppressed during multiprocessing
-        verbose = 1) # show folds and model fits as they complete
-
-    # Adjust test_size for debugging runs
-    X_train, X_test, y_train, y_test, lb = model_data.split_data(
-        model_matrix, test_size = .20)
-
+    search_opts = search_opts or pipeline_tools.build_search_options(grid_path)
+    logging.info('searching the grid with {}'.format(search_opts))
+    n_splits = None
+    if cv is None and search_opts.get('temporal'):
+        cv = TemporalSplit(**search_opts['temporal'])
+    if isinstance(cv, TemporalSplit):
+        if cv.date_level in model_matrix.index.names:
+            # every fold, so the holdout does not take one of the n_splits
+            n_splits = cv.n_splits
+            cv = [(train, test) for _, train, test in TemporalSplit(
+                window = cv.window, train_dates = cv.train_dates,
+                gap = cv.gap, date_level = cv.date_level).folds(model_matrix)]
+        else:
+            logging.warning('the model matrix has no {} index level, '
+                'validating on random folds instead'.format(cv.date_level))
+            cv = None
+
+    if cv is None:
+        # Adjust test_size for debugging runs
+        X_train, X_test, y_train, y_test, lb = model_data.split_data(
+            model_matrix, outcome_name = outcome_name, test_size = .20)
+    else:
+        X_train, X_test, y_train, y_test, lb, cv = split_holdout(
+            model_matrix, cv, outcome_name = outcome_name,
+            n_splits = n_splits)
+    grid_search = search.make_search(pipeline, param_grid, search_opts,
+        scoring = scoring, cv = cv)
+
+    if preprocess_cache is not None:
+        entries_before = preprocess_cache.n_entries()
     with pipeline_tools.Timer() as t:
         logging.info('fitting the grid search')
         grid_search.fit(X_train, y_train)
+    if preprocess_cache is not None:
+        n_fits = getattr(grid_search, 'n_preprocessing_fits_',
+            len(grid_search.cv_results_['params']) * grid_search.n_splits_ + 1)
+        preprocess_cache.log_stats(entries_before,
+            n_fits * (len(pipeline.steps) - 1))
 
     logging.info(reporting.pickle_model(grid_search,
         pkldir, lb, alg_id, model_tag = alg_name))
@@ -63,7 +107,8 @@ def fit_pipeline(model_matrix, grid_path, pkldir,
         train_results = reporting.get_results(grid_search, X_train, y_train, lb)
         test_results = reporting.get_results(grid_search, X_test, y_test, lb)
         logging.info(reporting.output_predictions(
-            train_results, test_results, engine, alg_id = alg_id))
+            train_results, test_results, engine, alg_id = alg_id,
+            batch_size = batch_size))
     return grid_search, lb
 
 
@@ -93,26 +138,90 @@ def main(args=None):
     parser.add_argument('--id', dest = 'alg_id', type = int,
         nargs = '*', default = None,
         help = 'Algorithm id for pre-trained models')
+    parser.add_argument('--max_workers', dest = 'max_workers', type = int,
+        default = None,
+        help = 'Number of feature tables to pull from the database at once')
+    parser.add_argument('--memory_budget', dest = 'memory_budget',
+        type = float, default = None,
+        help = 'Stream feature tables using at most this many GB of memory')
+    parser.add_argument('--batch_size', dest = 'batch_size', type = int,
+        default = 50000,
+        help = 'Number of prediction rows written to the database per batch')
+    parser.add_argument('--cachedir', dest = 'cache_dir',
+        default = os.path.join('~', '.cache', 'customer_propensity', 'features'),
+        help = 'Path to the local cache of pulled feature tables')
+    parser.add_argument('--no-cache', dest = 'use_cache',
+        default = True, action = 'store_false',
+        help = 'Pull all feature tables from the database without caching')
+    parser.add_argument('--refresh-cache', dest = 'refresh_cache',
+        default = False, action = 'store_true',
+        help = 'Pull all feature tables from the database and update the cache')
+    parser.add_argument('--preprocess-cachedir', dest = 'preprocess_cache_dir',
+        default = None,
+        help = 'Path to keep fitted preprocessing steps in between runs '
+            '(a temporary directory by default)')
+    parser.add_argument('--no-preprocess-cache', dest = 'use_preprocess_cache',
+        default = True, action = 'store_false',
+        help = 'Refit the preprocessing steps for every grid search candidate')
+    parser.add_argument('--foldstore', dest = 'fold_store', default = None,
+        help = 'Fit on the model matrix and temporal folds of a fold store '
+            '(see temporal_cv.build_fold_store) instead of the database')
+    parser.add_argument('--outcome', dest = 'outcome_name',
+        default = 'canceled',
+        help = 'Name of the outcome column of the fold store')
     args = parser.parse_args()
+    if args.fold_store and args.predict_new:
+        parser.error('--predict needs models fit on the database')
 
     logging.basicConfig(format = "%(asctime)s\t %(message)s",
         level = logging.DEBUG, datefmt = "%m/%d/%y %I:%M:%S %p")
 
     #engine = model_data.connect_to_database(args.path, args.group)
 
+    if args.train_model and args.fold_store:
+        model_matrix, folds = FoldStore(args.fold_store).load()
+        preprocess_cache = pipeline_tools.PreprocessingCache(
+            args.preprocess_cache_dir) if args.use_preprocess_cache else None
+        fit_pipeline(model_matrix, args.grid_path, args.pkldir,
+            alg_name = os.path.basename(os.path.normpath(args.fold_store)),
+            write_predictions = False, preprocess_cache = preprocess_cache,
+            cv = folds, outcome_name = args.outcome_name)
+        if preprocess_cache is not None:
+            preprocess_cache.cleanup()
+        return
+
     if args.train_model:
         alg_id_list = []
         pipelines = []
+        cache = None
+        if args.use_cache:
+            try:
+                cache = FeatureCache(args.cache_dir,
+                    refresh = args.refresh_cache)
+            except ImportError as e:
+                logging.warning('{}, pulling feature tables without the '
+                    'cache'.format(e))
+        search_opts = pipeline_tools.build_search_options(args.grid_path)
         for dyaml in args.data_yaml:
             model_matrix, alg_id, alg_name = model_data.get_data_for_modeling(
                 filename = dyaml,
                 # by default, sqlalchemy.create_engine has no default timeout
-                engine = model_data.connect_to_database(args.path, args.group))
+                engine = model_data.connect_to_database(args.path, args.group),
+                max_workers = args.max_workers, cache = cache,
+                memory_budget = args.memory_budget,
+                search_opts = search_opts)
             alg_id_list.append(alg_id)
+            preprocess_cache = pipeline_tools.PreprocessingCache(
+                args.preprocess_cache_dir) if args.use_preprocess_cache else None
             pipelines.append(
                 fit_pipeline(model_matrix, args.grid_path,
                 args.pkldir, alg_id, alg_name,
-                path = args.path, group = args.group))
+                path = args.path, group = args.group,
+                batch_size = args.batch_size,
+                preprocess_cache = preprocess_cache,
+                search_opts = search_opts))
+            if preprocess_cache is not None:
+                preprocess_cache.cleanup()
     else:
         alg_id_list = args.alg_id
         pipelines = [reporting.load_model(args.pkldir, alg_id)
@@ -124,7 +233,10 @@ def main(args=None):
             logging.info(reporting.write_current_predictions(
                 pipeline[0], filename = dyaml,
                 conn = model_data.connect_to_database(args.path, args.group),
-                label_encoder = pipeline[1], alg_id = alg_id))
+                label_encoder = pipeline[1], alg_id = alg_id,
+                max_workers = args.max_workers,
+                memory_budget = args.memory_budget,
+                batch_size = args.batch_size))
 
 if __name__ == '__main__':
     main()
@@ -1,20 +1,247 @@
-from io import BytesIO, StringIO
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from argparse import ArgumentParser
+from contextlib import closing
+from botocore.exceptions import ClientError
 import pandas as pd
 import boto3
-import os, logging
+import io, os, logging, gzip, threading, json, uuid, hashlib
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+# S3 rejects multipart uploads whose parts (other than the last) are smaller
+MIN_PART_SIZE = 5 * 2**20
+
+
+class MultipartWriter:
+    """A write-only file object that uploads what is written to it as the
+    parts of an S3 multipart upload. Each part is uploaded in the background
+    as soon as part_size bytes have been buffered, with at most max_workers
+    parts in flight, so memory stays under about part_size * (max_workers + 1).
+    Objects smaller than one part are sent with a single put_object call.
+
+    Usage:
+        with MultipartWriter(client, bucket, key) as writer:
+            writer.write(data)
+        writer.size, writer.etag
+    """
+    def __init__(self, client, bucket, key, part_size = 16 * 2**20,
+            max_workers = 4):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.size = 0
+        self.etag = None
+        self.closed = False
+        self._buffer = BytesIO()
+        self._upload_id = None
+        self._parts = dict()
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers = max_workers)
+        self._in_flight = threading.BoundedSemaphore(max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.write(data)
+        self.size += len(data)
+        if self._buffer.tell() >= self.part_size:
+            self._submit_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                response = self.client.put_object(Bucket = self.bucket,
+                    Key = self.key, Body = self._buffer.getvalue())
+            else:
+                if self._buffer.tell():
+                    self._submit_part()
+                for future in self._futures:
+                    future.result()
+                response = self.client.complete_multipart_upload(
+                    Bucket = self.bucket, Key = self.key,
+                    UploadId = self._upload_id,
+                    MultipartUpload = {'Parts': [
+                        {'PartNumber': number, 'ETag': self._parts[number]}
+                        for number in sorted(self._parts)]})
+        except Exception:
+            self.abort()
+            raise
+        self._executor.shutdown()
+        self.etag = response['ETag']
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+        self._executor.shutdown()
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(Bucket = self.bucket,
+                Key = self.key, UploadId = self._upload_id)
+
+    def _submit_part(self):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(
+                Bucket = self.bucket, Key = self.key)['UploadId']
+        body = self._buffer.getvalue()
+        self._buffer = BytesIO()
+        number = len(self._futures) + 1
+        # block until a slot is free so buffered parts cannot pile up
+        self._in_flight.acquire()
+        self._futures.append(self._executor.submit(
+            self._upload_part, number, body))
+
+    def _upload_part(self, number, body):
+        try:
+            self._parts[number] = self.client.upload_part(
+                Bucket = self.bucket, Key = self.key,
+                UploadId = self._upload_id,
+                PartNumber = number, Body = body)['ETag']
+        finally:
+            self._in_flight.release()
+
+
+class S3RangeReader(io.RawIOBase):
+    """A seekable read-only file object over an S3 object that fetches only
+    the byte ranges actually read, so a Parquet reader can pull the footer
+    and the column chunks it needs without downloading the whole object.
+    """
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = client.head_object(Bucket = bucket, Key = key)['ContentLength']
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, min(offset, self.size))
+        return self.position
+
+    def read(self, n = -1):
+        if n is None or n < 0:
+            n = self.size - self.position
+        n = min(n, self.size - self.position)
+        if n <= 0:
+            return b''
+        data = self.client.get_object(Bucket = self.bucket, Key = self.key,
+            Range = 'bytes={}-{}'.format(
+                self.position, self.position + n - 1))['Body'].read()
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+_filter_ops = {
+    '==': lambda values, value: values == value,
+    '!=': lambda values, value: values != value,
+    '<': lambda values, value: values < value,
+    '<=': lambda values, value: values <= value,
+    '>': lambda values, value: values > value,
+    '>=': lambda values, value: values >= value,
+    'in': lambda values, value: values.isin(value)}
+
+
+def apply_filters(data, filters):
+    """Keep the rows of a dataframe matching every (column, op, value) filter,
+    with op one of ==, !=, <, <=, >, >= or in."""
+    if not filters:
+        return data
+    keep = pd.Series(True, index = data.index)
+    for col, op, value in filters:
+        keep &= _filter_ops[op](data[col], value)
+    return data[keep]
+
+
+def row_group_may_match(row_group, filters):
+    """Use the min/max statistics of a Parquet row group to rule it out when
+    no row in it can match the filters."""
+    names = [row_group.column(i).path_in_schema
+        for i in range(row_group.num_columns)]
+    for col, op, value in filters or []:
+        if col not in names:
+            continue
+        stats = row_group.column(names.index(col)).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        low, high = stats.min, stats.max
+        if ((op == '==' and (value < low or value > high))
+                or (op == '<' and low >= value)
+                or (op == '<=' and low > value)
+                or (op == '>' and high <= value)
+                or (op == '>=' and high < value)
+                or (op == 'in' and not any(low <= v <= high for v in value))):
+            return False
+    return True
 
 
 class S3ReadWrite:
 
-    def __init__(self, bucket, folder):
-        self.client = boto3.client('s3')
-        self.resource = boto3.resource('s3')
+    def __init__(self, bucket, folder, endpoint_url = None,
+            cache_dir = None, cache_bytes = 20 * 2**30, immutable_prefixes = ()):
+        # endpoint_url points the client at a local S3 stand-in for testing
+        self.client = boto3.client('s3', endpoint_url = endpoint_url)
+        self.resource = boto3.resource('s3', endpoint_url = endpoint_url)
         self.folder = folder
         self.bucket = bucket
+        # opt-in read-through disk cache, see cached_object
+        self.cache_dir = cache_dir and os.path.expanduser(cache_dir)
+        self.cache_bytes = cache_bytes
+        self.immutable_prefixes = tuple(immutable_prefixes)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache_lock = threading.Lock()
+        # cached copies being opened, which eviction leaves alone
+        self._pinned = dict()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok = True)
 
     def __str__(self):
         msg = '(folder: {}, bucket: {})'.format(
             str(self.folder), str(self.bucket))
+        if self.cache_dir:
+            msg += ' cache hits: {}, misses: {}'.format(
+                self.cache_hits, self.cache_misses)
         return msg
 
     def __eq__(self, other):
@@ -55,30 +282,344 @@ class S3ReadWrite:
     def bucket(self, new_bucket):
         self._bucket = new_bucket
 
-    def read_from_S3_csv(self, csv_path, csv_name, **read_csv_kwargs):
-        value = self.client.get_object(
-                Bucket = self.bucket,
-                Key ='{folder}/{csv_path}/{csv_name}.csv'.format(
-                        folder = self.folder,
-                        csv_path = csv_path,
-                        csv_name = csv_name)
-                )['Body'].read()
-        return pd.read_csv(BytesIO(value),**read_csv_kwargs)
+    def csv_key(self, csv_path, csv_name, compression = None):
+        return '{folder}/{csv_path}/{csv_name}.csv{ext}'.format(
+            folder = self.folder,
+            csv_path = csv_path,
+            csv_name = csv_name,
+            ext = '.gz' if compression == 'gzip' else '')
+
+    def read_from_S3_csv(self, csv_path, csv_name, compression = None,
+            row_filter = None, **read_csv_kwargs):
+        """Read a csv object by streaming the response body straight into the
+        parser, so the raw object is never held in memory next to the frame.
+        Args:
+            csv_path (str): the path of the object inside the folder
+            csv_name (str): the name of the object without extension
+            compression (str): 'gzip' to read a .csv.gz object, decompressing
+                it on the fly
+            row_filter (callable): optional function applied to each chunk
+                as it is read, e.g. to drop rows, before chunks are combined
+            read_csv_kwargs: passed on to pandas.read_csv, e.g. usecols to
+                project columns or chunksize to get an iterator of chunks
+        Returns:
+            pandas.DataFrame: the data, or an iterator of dataframes if
+                chunksize is given without a row_filter
+        """
+        return self.read_csv_key(self.csv_key(csv_path, csv_name, compression),
+            row_filter = row_filter, **read_csv_kwargs)
+
+    def read_csv_key(self, key, row_filter = None, **read_csv_kwargs):
+        """Read a csv object by its full key, see read_from_S3_csv. Keys ending
+        in .gz are decompressed on the fly."""
+        compression = 'gzip' if key.endswith('.gz') else None
+        if self.cache_dir:
+            body = self.cached_object(key)
+        else:
+            body = self.client.get_object(
+                Bucket = self.bucket, Key = key)['Body']
+        if row_filter is None:
+            if read_csv_kwargs.get('chunksize') or read_csv_kwargs.get(
+                    'iterator'):
+                # the chunks are read lazily, so the body stays open
+                return pd.read_csv(body, compression = compression,
+                    **read_csv_kwargs)
+            with closing(body):
+                return pd.read_csv(body, compression = compression,
+                    **read_csv_kwargs)
+        read_csv_kwargs.setdefault('chunksize', 100000)
+        with closing(body):
+            chunks = pd.read_csv(body, compression = compression,
+                **read_csv_kwargs)
+            return pd.concat([row_filter(chunk) for chunk in chunks],
+                ignore_index = True)
+
+    def cached_object(self, key):
+        """Open a local copy of an object, downloading it on a miss. A cached
+        copy is revalidated with a conditional request on its ETag unless its
+        key, relative to the folder, starts with one of the immutable
+        prefixes (e.g. dated snapshots), in which case it is used as is.
+        Least recently used copies are evicted once the cache grows past
+        cache_bytes. A copy is pinned until it is open, so a concurrent
+        eviction never removes it from under a reader; once open, it can be
+        read to the end even if it is evicted.
+        Args:
+            key (str): the full key of the object
+        Returns:
+            file: the local copy of the object opened for binary reading
+        """
+        name = hashlib.sha1('{}/{}'.format(
+            self.bucket, key).encode('utf-8')).hexdigest()
+        path = os.path.join(self.cache_dir, name)
+        with self._cache_lock:
+            self._pinned[path] = self._pinned.get(path, 0) + 1
+        try:
+            return open(self._cached_path(key, path), 'rb')
+        finally:
+            with self._cache_lock:
+                self._pinned[path] -= 1
+                if not self._pinned[path]:
+                    del self._pinned[path]
+
+    def _cached_path(self, key, path):
+        meta_path = path + '.json'
+        response = None
+        if os.path.exists(path) and os.path.exists(meta_path):
+            if self._relative_key(key).startswith(self.immutable_prefixes):
+                return self._cache_hit(path)
+            with open(meta_path) as f:
+                etag = json.load(f)['etag']
+            try:
+                response = self.client.get_object(Bucket = self.bucket,
+                    Key = key, IfNoneMatch = etag)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                    raise
+                return self._cache_hit(path)
+        if response is None:
+            response = self.client.get_object(Bucket = self.bucket, Key = key)
+
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            for chunk in response['Body'].iter_chunks(2**20):
+                f.write(chunk)
+        os.replace(tmp_path, path)
+        with open(meta_path, 'w') as f:
+            json.dump({'key': key, 'etag': response['ETag']}, f)
+        with self._cache_lock:
+            self.cache_misses += 1
+            self._evict()
+        return path
+
+    def _relative_key(self, key):
+        prefix = '{}/'.format(self.folder)
+        return key[len(prefix):] if key.startswith(prefix) else key
+
+    def _cache_hit(self, path):
+        os.utime(path)
+        with self._cache_lock:
+            self.cache_hits += 1
+        return path
+
+    def _evict(self):
+        # called under the cache lock, so no copy gets pinned meanwhile
+        entries = [os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if not name.endswith(('.json', '.tmp'))]
+        entries = sorted(((os.path.getmtime(path), os.path.getsize(path), path)
+            for path in entries), reverse = True)
+        total = 0
+        for _, size, path in entries:
+            total += size
+            if total > self.cache_bytes and path not in self._pinned:
+                os.remove(path)
+                os.remove(path + '.json')
+
+    def parquet_key(self, path, name):
+        return '{folder}/{path}/{name}.parquet'.format(
+            folder = self.folder,
+            path = path,
+            name = name)
+
+    def read_from_S3_parquet(self, path, name, columns = None, filters = None):
+        """Read a Parquet object, fetching only the requested columns and only
+        the row groups whose statistics can match the filters.
+        Args:
+            path (str): the path of the object inside the folder
+            name (str): the name of the object without extension
+            columns (list[str]): columns to read, all columns if None
+            filters (list[tuple]): (column, op, value) conditions that every
+                returned row satisfies, with op one of ==, !=, <, <=, >, >=, in
+        Returns:
+            pandas.DataFrame: the matching rows of the requested columns
+        """
+        if pyarrow is None:
+            raise ImportError('reading Parquet requires pyarrow')
+        key = self.parquet_key(path, name)
+        source = (self.cached_object(key) if self.cache_dir
+            else S3RangeReader(self.client, self.bucket, key))
+        with closing(source):
+            parquet_file = pq.ParquetFile(source)
+            row_groups = [i for i in range(parquet_file.num_row_groups)
+                if row_group_may_match(
+                    parquet_file.metadata.row_group(i), filters)]
+            # filter columns have to be read too, then dropped
+            read_columns = columns and list(columns) + [col for col, _, _
+                in filters or [] if col not in columns]
+            data = parquet_file.read_row_groups(row_groups,
+                columns = read_columns).to_pandas()
+        data = apply_filters(data, filters)
+        return data[columns] if columns else data
+
+    def read_columns(self, path, name, columns = None, filters = None):
+        """Read only the given columns and rows of a snapshot, from its Parquet
+        copy when one exists and otherwise from its csv object (projecting
+        and filtering while the csv streams in).
+        Args:
+            path (str): the path of the object inside the folder
+            name (str): the name of the object without extension
+            columns (list[str]): columns to read, all columns if None
+            filters (list[tuple]): (column, op, value) row conditions
+        Returns:
+            pandas.DataFrame: the matching rows of the requested columns
+        """
+        if pyarrow is not None:
+            try:
+                return self.read_from_S3_parquet(path, name,
+                    columns = columns, filters = filters)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise
+        usecols = columns and list(columns) + [col for col, _, _
+            in filters or [] if col not in columns]
+        data = self.read_from_S3_csv(path, name, usecols = usecols,
+            row_filter = (lambda chunk: apply_filters(chunk, filters))
+                if filters else None)
+        return data[columns] if columns else data
+
+    def read_many(self, csv_path, csv_names, max_workers = 8,
+            reader = None, **read_csv_kwargs):
+        """Fetch and parse several csv objects concurrently, yielding each
+        one as soon as it is ready. Objects that fail are logged by key and
+        reported together once every other object has been yielded.
+        Args:
+            csv_path (str): the path of the objects inside the folder
+            csv_names (list[str]): names of the objects without extension
+            max_workers (int): maximum number of objects read at once
+            reader (callable): the method reading a single object, by default
+                read_from_S3_csv (e.g. read_columns for snapshots)
+            read_csv_kwargs: passed on to the reader for every object
+        Yields:
+            (str, pandas.DataFrame): the name of an object and its data, in
+                order of completion
+        """
+        reader = reader or self.read_from_S3_csv
+        failed = dict()
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            pending = {executor.submit(reader,
+                    csv_path, csv_name, **read_csv_kwargs): csv_name
+                for csv_name in csv_names}
+            for future in as_completed(pending):
+                csv_name = pending[future]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    key = self.csv_key(csv_path, csv_name)
+                    logging.error('failed to read s3://{}/{}: {}'.format(
+                        self.bucket, key, e))
+                    failed[key] = e
+                    continue
+                yield csv_name, data
+        if failed:
+            raise IOError('failed to read {} of {} objects from {}: {}'.format(
+                len(failed), len(pending), self.bucket,
+                ', '.join(failed.keys()))) from next(iter(failed.values()))
 
     def put_dataframe_to_S3(
             self,
             csv_path,
             csv_name,
-            dataframe):
-        csv_buffer = StringIO()
-        dataframe.to_csv(csv_buffer, index=False, header=True)
-        self.resource.Bucket(
-            self.bucket).put_object(
-            Key= '{folder}/{csv_path}/{csv_name}.csv'.format(
-                folder = self.folder,
-                csv_path = csv_path,
-                csv_name = csv_name),
-            Body=csv_buffer.getvalue())
+            dataframe,
+            compression = None,
+            chunk_rows = 100000,
+            part_size = 16 * 2**20,
+            max_workers = 4):
+        """Write a dataframe as a csv object, serializing it a chunk of rows
+        at a time (optionally through gzip) into a multipart upload, so that
+        only a few parts of text are ever in memory next to the frame.
+        Args:
+            csv_path (str): the path of the object inside the folder
+            csv_name (str): the name of the object without extension
+            dataframe (pandas.DataFrame): the data to write
+            compression (str): 'gzip' to write a .csv.gz object
+            chunk_rows (int): number of rows serialized at a time
+            part_size (int): bytes per uploaded part (at least 5 MB)
+            max_workers (int): maximum number of parts uploaded at once
+        Returns:
+            dict: the key, size in bytes and ETag of the written object
+        """
+        key = self.csv_key(csv_path, csv_name, compression)
+        with MultipartWriter(self.client, self.bucket, key,
+                part_size = part_size, max_workers = max_workers) as writer:
+            out = (gzip.GzipFile(fileobj = writer, mode = 'wb')
+                if compression == 'gzip' else writer)
+            for start in range(0, max(len(dataframe), 1), chunk_rows):
+                out.write(dataframe.iloc[start:start + chunk_rows].to_csv(
+                    index = False, header = start == 0).encode('utf-8'))
+            if out is not writer:
+                out.close()
+        return {'key': key, 'size': writer.size, 'etag': writer.etag}
+
+    def put_dataframe_to_S3_parquet(self, path, name, dataframe,
+            row_group_size = 100000, part_size = 16 * 2**20, max_workers = 4):
+        """Write a dataframe as a Parquet object with min/max statistics per
+        row group, converting and uploading one row group at a time.
+        Args:
+            path (str): the path of the object inside the folder
+            name (str): the name of the object without extension
+            dataframe (pandas.DataFrame): the data to write
+            row_group_size (int): number of rows per row group
+            part_size (int): bytes per uploaded part (at least 5 MB)
+            max_workers (int): maximum number of parts uploaded at once
+        Returns:
+            dict: the key, size in bytes and ETag of the written object
+        """
+        if pyarrow is None:
+            raise ImportError('writing Parquet requires pyarrow')
+        key = self.parquet_key(path, name)
+        schema = pyarrow.Schema.from_pandas(dataframe, preserve_index = False)
+        with MultipartWriter(self.client, self.bucket, key,
+                part_size = part_size, max_workers = max_workers) as writer:
+            parquet_writer = pq.ParquetWriter(writer, schema,
+                write_statistics = True)
+            for start in range(0, len(dataframe), row_group_size):
+                parquet_writer.write_table(pyarrow.Table.from_pandas(
+                    dataframe.iloc[start:start + row_group_size],
+                    schema = schema, preserve_index = False))
+            parquet_writer.close()
+        return {'key': key, 'size': writer.size, 'etag': writer.etag}
+
+    def head(self, key):
+        """Return the metadata of an object, or None if it does not exist."""
+        try:
+            return self.client.head_object(Bucket = self.bucket, Key = key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            return None
+
+    def upload_record_key(self, csv_path, csv_name):
+        return '{folder}/{csv_path}/_uploaded/{csv_name}.json'.format(
+            folder = self.folder,
+            csv_path = csv_path,
+            csv_name = csv_name)
+
+    def record_upload(self, csv_path, csv_name, written):
+        """Record the size and ETag of a completed upload next to it, for
+        is_uploaded to check against later.
+        Args:
+            written (dict): the key, size and etag returned by the upload
+        """
+        self.client.put_object(Bucket = self.bucket,
+            Key = self.upload_record_key(csv_path, csv_name),
+            Body = json.dumps(written).encode('utf-8'))
+
+    def is_uploaded(self, csv_path, csv_name):
+        """Check that an object was completely uploaded: its upload was
+        recorded and the object still has the recorded size and ETag.
+        Returns:
+            bool: whether the upload can be skipped
+        """
+        try:
+            body = self.client.get_object(Bucket = self.bucket,
+                Key = self.upload_record_key(csv_path, csv_name))['Body']
+        except self.client.exceptions.NoSuchKey:
+            return False
+        written = json.loads(body.read().decode('utf-8'))
+        head = self.head(written['key'])
+        return (head is not None
+            and head['ContentLength'] == written['size']
+            and head['ETag'] == written['etag'])
 
     def put_to_S3(self, key, body):
         self.resource.Bucket(
@@ -87,18 +628,140 @@ class S3ReadWrite:
             key,
             Body=body)
 
-    def append_to_csv(self, dataframe, csv_name):
+    def append_to_csv(self, dataframe, csv_name, compression = None):
+        """Append rows to a partitioned csv dataset. Each call writes the rows
+        as a new part object under {folder}/{csv_name}/ and adds it to the
+        dataset's manifest, so an append costs only the size of the batch.
+        Appends are not safe to run concurrently on the same dataset.
+        Args:
+            dataframe (pandas.DataFrame): the rows to append
+            csv_name (str): the name of the dataset
+            compression (str): 'gzip' to write the part as .csv.gz
+        Returns:
+            str: the key of the new part
+        """
+        part_name = 'part-{}-{}'.format(
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), uuid.uuid4().hex[:8])
+        info = self.put_dataframe_to_S3(csv_name, part_name, dataframe,
+            compression = compression)
+        manifest = self.read_manifest(csv_name)
+        manifest['parts'].append({'key': info['key'],
+            'rows': len(dataframe), 'size': info['size']})
+        self.write_manifest(csv_name, manifest)
+        return info['key']
+
+    def read_appended_csv(self, csv_name, **read_csv_kwargs):
+        """Read all parts of a partitioned csv dataset in order of appending.
+        Args:
+            csv_name (str): the name of the dataset
+            read_csv_kwargs: passed on to pandas.read_csv for every part
+        Returns:
+            pandas.DataFrame: the rows of every part
+        """
+        parts = list(self.iter_appended_csv(csv_name, **read_csv_kwargs))
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat(parts, ignore_index = True)
+
+    def iter_appended_csv(self, csv_name, **read_csv_kwargs):
+        """Stream the parts of a partitioned csv dataset one at a time.
+        Yields:
+            pandas.DataFrame: the rows of each part in order of appending
+        """
+        for part in self.read_manifest(csv_name)['parts']:
+            yield self.read_csv_key(part['key'], **read_csv_kwargs)
+
+    def compact_csv(self, csv_name, max_part_size = 64 * 2**20,
+            compression = None):
+        """Merge the small parts of a partitioned csv dataset into one part.
+        The manifest is switched to the merged part before the small parts
+        are deleted, so readers never see missing or duplicated rows.
+        Args:
+            csv_name (str): the name of the dataset
+            max_part_size (int): parts smaller than this many bytes are merged
+            compression (str): 'gzip' to write the merged part as .csv.gz
+        Returns:
+            int: the number of parts merged
+        """
+        manifest = self.read_manifest(csv_name)
+        small = [part for part in manifest['parts']
+            if part['size'] < max_part_size]
+        if len(small) < 2:
+            return 0
+        data = pd.concat([self.read_csv_key(part['key']) for part in small],
+            ignore_index = True)
+        merged_name = 'part-{}-{}'.format(
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), 'compacted')
+        info = self.put_dataframe_to_S3(csv_name, merged_name, data,
+            compression = compression)
+        merged = {'key': info['key'], 'rows': len(data), 'size': info['size']}
+
+        # the merged part takes the place of the first small part
+        small_keys = set(part['key'] for part in small)
+        parts = []
+        for part in manifest['parts']:
+            if part['key'] not in small_keys:
+                parts.append(part)
+            elif merged is not None:
+                parts.append(merged)
+                merged = None
+        manifest['parts'] = parts
+        self.write_manifest(csv_name, manifest)
+
+        for key in small_keys:
+            self.client.delete_object(Bucket = self.bucket, Key = key)
+        logging.info('compacted {} parts of {} into {}'.format(
+            len(small), csv_name, info['key']))
+        return len(small)
+
+    def manifest_key(self, csv_name):
+        return '{folder}/{csv_name}/_manifest.json'.format(
+            folder = self.folder,
+            csv_name = csv_name)
+
+    def read_manifest(self, csv_name):
+        """Read the manifest of a partitioned csv dataset. A dataset written
+        by the old read-modify-write append as a single {csv_name}.csv object
+        starts out with that object as its first part.
+        Returns:
+            dict: the manifest with the list of parts in order of appending
+        """
         try:
-            data = pd.concat([self.read_from_S3_csv(
-                csv_name), dataframe], ignore_index=True)
-        except Exception as e:
-            data = dataframe
+            body = self.client.get_object(Bucket = self.bucket,
+                Key = self.manifest_key(csv_name))['Body']
+            return json.loads(body.read().decode('utf-8'))
+        except self.client.exceptions.NoSuchKey:
+            pass
 
-        csv_buffer = StringIO()
-        data.to_csv(csv_buffer, index=False)
-        self.resource.Bucket(
-            self.bucket).put_object(
-            Key='{folder}/{csv_name}.csv'.format(
-                folder = self.folder,
-                csv_name = csv_name),
-            Body=csv_buffer.getvalue())
+        manifest = {'parts': []}
+        legacy_key = '{folder}/{csv_name}.csv'.format(
+            folder = self.folder, csv_name = csv_name)
+        try:
+            head = self.client.head_object(Bucket = self.bucket,
+                Key = legacy_key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+        else:
+            manifest['parts'].append({'key': legacy_key, 'rows': None,
+                'size': head['ContentLength']})
+        return manifest
+
+    def write_manifest(self, csv_name, manifest):
+        self.client.put_object(Bucket = self.bucket,
+            Key = self.manifest_key(csv_name),
+            Body = json.dumps(manifest, indent = 1).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Compact the small parts of an appended csv dataset')
+    parser.add_argument('--bucket', help = 'S3 bucket of the dataset')
+    parser.add_argument('--folder', help = 'folder of the dataset in the bucket')
+    parser.add_argument('--name', help = 'name of the dataset')
+    parser.add_argument('--max_part_mb', type = int, default = 64,
+        help = 'parts smaller than this many megabytes are merged')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    s3 = S3ReadWrite(args.bucket, args.folder)
+    s3.compact_csv(args.name, max_part_size = args.max_part_mb * 2**20)
@@ -9,6 +9,81 @@ import logging
 from argparse import ArgumentParser
 from s3_read_write import S3ReadWrite
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import queue, threading
+
+
+def extract_and_upload(query, engine, s3_writer, dates, csv_path = 'ETLV_v2',
+        n_extract = 2, n_upload = 2, queue_size = 2, resume = False):
+    """Run the extract for every date and upload the results, with n_extract
+    queries and n_upload uploads running at once. Extracted frames wait for
+    an uploader in a queue of at most queue_size frames, so no more than
+    n_extract + queue_size + n_upload frames are held in memory. A failed
+    date does not stop the others.
+    Args:
+        query (sqlalchemy.sql.elements.TextClause): the extract, taking :end_date
+        engine (sqlalchemy.engine.Engine): the database engine
+        s3_writer (S3ReadWrite): where the extracts are uploaded
+        dates (list[str]): the dates to extract YYYY-MM-DD
+        csv_path (str): the path of the extracts inside the folder
+        n_extract (int): number of extracts run at once
+        n_upload (int): number of uploads run at once
+        queue_size (int): number of extracted frames waiting for an upload
+        resume (bool): skip dates whose upload was recorded and whose object
+            still has the recorded size and ETag
+    Returns:
+        dict: the exception raised for each failed date
+    """
+    if resume:
+        done = [date for date in dates
+            if s3_writer.is_uploaded(csv_path, date)]
+        logging.info('skipping {} dates already uploaded: {}'.format(
+            len(done), ', '.join(done)))
+        dates = [date for date in dates if date not in done]
+
+    extracted = queue.Queue(maxsize = queue_size)
+    failed = dict()
+
+    def extract(date):
+        try:
+            data = pd.read_sql_query(query, engine,
+                params = {'end_date': date})
+        except Exception as e:
+            logging.exception('extract failed for {}'.format(date))
+            failed[date] = e
+            return
+        logging.info('data pulled for {}'.format(date))
+        extracted.put((date, data))
+
+    def upload():
+        while True:
+            item = extracted.get()
+            if item is None:
+                return
+            date, data = item
+            try:
+                written = s3_writer.put_dataframe_to_S3(csv_path = csv_path,
+                    csv_name = date, dataframe = data)
+                s3_writer.record_upload(csv_path, date, written)
+            except Exception as e:
+                logging.exception('upload failed for {}'.format(date))
+                failed[date] = e
+                continue
+            logging.info('data saved for {}'.format(date))
+
+    uploaders = [threading.Thread(target = upload) for _ in range(n_upload)]
+    for uploader in uploaders:
+        uploader.start()
+    try:
+        with ThreadPoolExecutor(max_workers = n_extract) as executor:
+            list(executor.map(extract, dates))
+    finally:
+        for _ in uploaders:
+            extracted.put(None)
+        for uploader in uploaders:
+            uploader.join()
+    return failed
+
 
 def main(args):
     logging.basicConfig(
@@ -33,7 +108,8 @@ def main(args):
           driver = "postgresql+psycopg2",
           host = "localhost",
           port = 5439,
-          dbname = "production"))
+          dbname = "production"),
+        pool_size = args.n_extract)
     logging.info('database connection initialized')
 
 
@@ -43,13 +119,13 @@ def main(args):
         folder = 'sample_input_data')
     logging.info('S3ReadWrite created in {}'.format(str(s3_writer)))
 
-    for date in outcome_dates:
-        data = pd.read_sql_query(query, connection,
-            params = {'end_date': date})
-        logging.info('data pulled for {}'.format(date))
-        s3_writer.put_dataframe_to_S3(csv_path = 'ETLV_v2',
-            csv_name = date, dataframe = data)
-        logging.info('data saved for {}'.format(date))
+    failed = extract_and_upload(query, connection, s3_writer, outcome_dates,
+        n_extract = args.n_extract, n_upload = args.n_upload,
+        queue_size = args.queue_size, resume = args.resume)
+    if failed:
+        logging.error('extract failed for {}; rerun with --resume'.format(
+            ', '.join(sorted(failed))))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -72,6 +148,17 @@ if __name__ == '__main__':
     parser.add_argument('--n_folds', type = int,
         help = 'number of folds for temporal CV',
         default = 10)
+    parser.add_argument('--n_extract', type = int,
+        help = 'number of dates extracted at once',
+        default = 2)
+    parser.add_argument('--n_upload', type = int,
+        help = 'number of extracts uploaded at once',
+        default = 2)
+    parser.add_argument('--queue_size', type = int,
+        help = 'number of extracted dates waiting to be uploaded',
+        default = 2)
+    parser.add_argument('--resume', action = 'store_true',
+        help = 'skip dates already uploaded with a matching size and ETag')
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,69 @@
+import pandas as pd
+import numpy as np
+from customer_classify.column_buffer import ColumnBuffer
+
+
+def cohort_index(n_rows = 6):
+    return pd.MultiIndex.from_arrays([np.arange(n_rows), [2018] * n_rows],
+        names = ['aamc_id', 'application_year'])
+
+
+def chunk_for(index, positions, **columns):
+    return pd.DataFrame(columns, index = index[positions])
+
+
+def test_partially_covered_categorical_table():
+    index = cohort_index()
+    buffer = ColumnBuffer(index, {'tbl': ['state']}, {'state': 'category'})
+    buffer.append('tbl', chunk_for(index, [0, 2, 4],
+        state = pd.Categorical(['NY', 'CA', 'NY'])))
+
+    data = buffer.to_frame()
+
+    assert isinstance(data.state.dtype, pd.CategoricalDtype)
+    assert list(data.state.iloc[[0, 2, 4]]) == ['NY', 'CA', 'NY']
+    assert data.state.iloc[[1, 3, 5]].isnull().all()
+
+
+def test_partially_covered_bool_table():
+    index = cohort_index()
+    buffer = ColumnBuffer(index, {'tbl': ['flag']}, {'flag': 'bool'})
+    buffer.append('tbl', chunk_for(index, [0, 1, 2],
+        flag = [True, False, True]))
+
+    data = buffer.to_frame()
+
+    assert list(data.flag.iloc[:3]) == [True, False, True]
+    assert data.flag.iloc[3:].isnull().all()
+
+
+def test_bool_chunk_with_nulls():
+    index = cohort_index()
+    buffer = ColumnBuffer(index, {'tbl': ['flag']}, {'flag': 'bool'})
+    buffer.append('tbl', chunk_for(index, [0, 1, 2],
+        flag = [True, False, True]))
+    buffer.append('tbl', chunk_for(index, [3, 4, 5],
+        flag = pd.Series([None, True, False], dtype = object).values))
+
+    data = buffer.to_frame()
+
+    assert list(data.flag.iloc[[0, 1, 2, 4, 5]]) == [
+        True, False, True, True, False]
+    assert pd.isnull(data.flag.iloc[3])
+
+
+def test_partially_covered_integer_table():
+    index = cohort_index()
+    buffer = ColumnBuffer(index, {'tbl': ['n_apps'], 'other': ['gpa']},
+        {'n_apps': 'int16', 'gpa': 'float32'})
+    buffer.append('tbl', chunk_for(index, [1, 3], n_apps = np.array([2, 5],
+        dtype = 'int16')))
+    buffer.append('other', chunk_for(index, list(range(6)),
+        gpa = np.linspace(3, 4, 6, dtype = 'float32')))
+
+    data = buffer.to_frame()
+
+    assert data.n_apps.dtype == 'float32'
+    assert list(data.n_apps.iloc[[1, 3]]) == [2, 5]
+    assert data.n_apps.iloc[[0, 2, 4, 5]].isnull().all()
+    assert not data.gpa.isnull().any()
@@ -0,0 +1,35 @@
+import pickle
+import numpy as np
+import pandas as pd
+from customer_classify.pipeline_tools import DummyEncoder
+
+
+def frame(levels):
+    return pd.DataFrame({'gpa': np.linspace(3, 4, len(levels)),
+        'state': pd.Categorical(levels)})
+
+
+def test_transform_puts_unseen_levels_in_the_nan_dummy():
+    encoder = DummyEncoder().fit(frame(['NY', 'CA', None]))
+    transformed = encoder.transform(frame(['CA', 'TX'])).toarray()
+
+    assert list(encoder.transformed_columns) == [
+        'gpa', 'state_CA', 'state_NY', 'state_nan']
+    assert transformed[:, 1:].tolist() == [[1, 0, 0], [0, 0, 1]]
+
+
+def test_encoders_pickled_before_the_vocabulary_still_transform():
+    train = frame(['NY', 'CA', None])
+    encoder = DummyEncoder().fit(train)
+    # the attributes an encoder fitted by the old get_dummies version had
+    for name in ('sparse', 'vocabulary_', 'numeric_columns_'):
+        delattr(encoder, name)
+    encoder.transformed_columns = pd.get_dummies(train,
+        columns = encoder.columns, dummy_na = True).columns
+    old = pickle.loads(pickle.dumps(encoder))
+
+    transformed = old.transform(frame(['CA', 'TX']))
+
+    assert list(transformed.columns) == list(encoder.transformed_columns)
+    assert transformed[['state_CA', 'state_NY']].astype(int).values.tolist(
+        ) == [[1, 0], [0, 0]]
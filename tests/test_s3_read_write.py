@@ -0,0 +1,51 @@
+import time
+import pandas as pd
+import pytest
+
+moto = pytest.importorskip('moto')
+
+from s3_read_write import S3ReadWrite
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        s3 = S3ReadWrite('test-bucket', 'data')
+        s3.client.create_bucket(Bucket = 'test-bucket')
+        for name in ('2018-01-07', '2018-01-14', '2018-01-21'):
+            s3.put_dataframe_to_S3('snapshots', name,
+                pd.DataFrame({'internal_user_id': [1, 2], 'day': name}))
+        yield s3
+
+
+def test_read_many_yields_in_completion_order(s3):
+    delays = {'2018-01-07': .6, '2018-01-14': .3, '2018-01-21': 0}
+
+    def slow_reader(csv_path, csv_name, **read_csv_kwargs):
+        time.sleep(delays[csv_name])
+        return s3.read_from_S3_csv(csv_path, csv_name, **read_csv_kwargs)
+
+    results = list(s3.read_many('snapshots', sorted(delays),
+        max_workers = 3, reader = slow_reader))
+
+    assert [name for name, _ in results] == [
+        '2018-01-21', '2018-01-14', '2018-01-07']
+    for name, data in results:
+        assert list(data.day) == [name, name]
+
+
+def test_read_many_reports_every_failed_key(s3):
+    names = ['2018-01-07', 'missing-a', '2018-01-14', 'missing-b']
+    read = []
+    with pytest.raises(IOError) as error:
+        for name, data in s3.read_many('snapshots', names, max_workers = 2):
+            read.append(name)
+
+    assert sorted(read) == ['2018-01-07', '2018-01-14']
+    message = str(error.value)
+    assert 'failed to read 2 of 4 objects' in message
+    assert s3.csv_key('snapshots', 'missing-a') in message
+    assert s3.csv_key('snapshots', 'missing-b') in message
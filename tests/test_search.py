@@ -0,0 +1,67 @@
+import numpy as np
+from sklearn.datasets import make_classification
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import GridSearchCV
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from customer_classify import search
+
+
+def forest_pipeline(random_state = 1100):
+    return make_pipeline(StandardScaler(),
+        RandomForestClassifier(random_state = random_state))
+
+
+PARAM_GRID = {search.N_ESTIMATORS: [3, 8, 20],
+    'randomforestclassifier__max_features': [2, 'sqrt'],
+    'randomforestclassifier__bootstrap': [True, False]}
+
+
+def test_warm_start_scores_match_grid_search():
+    X, y = make_classification(n_samples = 200, n_features = 8,
+        random_state = 0)
+    warm = search.WarmStartForestSearch(forest_pipeline(), PARAM_GRID,
+        scoring = 'roc_auc', cv = 3, n_jobs = 1).fit(X, y)
+    grid = GridSearchCV(forest_pipeline(), PARAM_GRID, scoring = 'roc_auc',
+        cv = 3, n_jobs = 1).fit(X, y)
+
+    def by_params(results):
+        return {tuple(sorted(params.items())): score for params, score
+            in zip(results['params'], results['mean_test_score'])}
+    warm_scores, grid_scores = by_params(warm.cv_results_), by_params(
+        grid.cv_results_)
+    assert set(warm_scores) == set(grid_scores)
+    for params, score in grid_scores.items():
+        assert np.isclose(warm_scores[params], score), params
+    assert warm.best_params_ == grid.best_params_
+    assert np.isclose(warm.best_score_, grid.best_score_)
+
+
+def test_make_search_needs_a_seeded_forest_to_warm_start():
+    search_opts = {'strategy': 'exhaustive', 'cv': 3}
+    assert isinstance(search.make_search(forest_pipeline(), PARAM_GRID,
+        search_opts, scoring = 'roc_auc'), search.WarmStartForestSearch)
+    assert isinstance(search.make_search(forest_pipeline(None), PARAM_GRID,
+        search_opts, scoring = 'roc_auc'), GridSearchCV)
+    assert isinstance(search.make_search(forest_pipeline(), PARAM_GRID,
+        dict(search_opts, warm_start = False), scoring = 'roc_auc'),
+        GridSearchCV)
+
+
+def test_halving_over_a_grid_parameter_has_no_duplicate_candidates():
+    X, y = make_classification(n_samples = 200, n_features = 8,
+        random_state = 0)
+    param_grid = {search.N_ESTIMATORS: [3, 9, 27],
+        'randomforestclassifier__max_depth': [1, 3, None]}
+    halving = search.SuccessiveHalvingSearch(forest_pipeline(), param_grid,
+        scoring = 'roc_auc', cv = 3, n_jobs = 1, random_state = 0,
+        resource = search.N_ESTIMATORS, max_resources = 27).fit(X, y)
+
+    results = halving.cv_results_
+    rounds = dict()
+    for params, i in zip(results['params'], results['iter']):
+        rounds.setdefault(i, []).append(tuple(sorted(params.items())))
+    assert len(rounds[0]) == 3
+    for candidates in rounds.values():
+        assert len(candidates) == len(set(candidates))
+    assert halving.n_rounds_ == len(rounds) == 2
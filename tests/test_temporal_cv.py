@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+from customer_classify.temporal_cv import TemporalSplit, split_holdout
+
+
+def dated_matrix(n_users = 20, n_dates = 5):
+    dates = pd.date_range('2018-01-07', periods = n_dates, freq = '7D')
+    index = pd.MultiIndex.from_product([range(n_users), dates],
+        names = ['internal_user_id', 'input_date'])
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({'x': rng.normal(size = len(index)),
+        'canceled': np.arange(len(index)) % 2}, index = index)
+
+
+def test_split_holdout_keeps_the_last_date_out_of_every_fold():
+    data = dated_matrix()
+    folds = [(train, test) for _, train, test
+        in TemporalSplit(gap = 7).folds(data)]
+
+    X_train, X_test, y_train, y_test, lb, inner = split_holdout(data, folds,
+        outcome_name = 'canceled')
+
+    last = data.index.get_level_values('input_date').max()
+    assert (X_test.index.get_level_values('input_date') == last).all()
+    assert (X_train.index.get_level_values('input_date') < last).all()
+    assert len(inner) == len(folds) - 1
+    for train, test in inner:
+        train_dates = X_train.index.get_level_values('input_date')[train]
+        test_dates = X_train.index.get_level_values('input_date')[test]
+        assert train_dates.max() < test_dates.min()
+        assert test_dates.nunique() == 1
+
+
+def test_split_holdout_needs_enough_folds():
+    data = dated_matrix(n_dates = 3)
+    folds = [(train, test) for _, train, test
+        in TemporalSplit(gap = 7).folds(data)]
+    with pytest.raises(ValueError):
+        split_holdout(data, folds, outcome_name = 'canceled', n_splits = 2)
+
+
+def test_missing_date_level():
+    data = dated_matrix().reset_index('input_date', drop = True)
+    with pytest.raises(ValueError):
+        TemporalSplit().folds(data)
@@ -0,0 +1,96 @@
+import pytest
+from sqlalchemy import create_engine, event, inspect, text
+
+from upload_customer_lists import swap_tables
+
+
+class SwapFailed(Exception):
+    pass
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A SQLite stand-in for Redshift with an analytics schema, transactional
+    DDL like Postgres, and GRANT statements recorded instead of run."""
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'main.db'))
+    engine.grants = []
+    engine.fail_on = None
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        # let SQLAlchemy, not the driver, decide where transactions begin
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute("ATTACH DATABASE '{}' AS analytics".format(
+            tmp_path / 'analytics.db'))
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+    @event.listens_for(engine, 'before_cursor_execute', retval = True)
+    def before_cursor_execute(connection, cursor, statement, parameters,
+            context, executemany):
+        if engine.fail_on and statement.startswith(engine.fail_on):
+            raise SwapFailed(statement)
+        if statement.startswith('GRANT'):
+            engine.grants.append(statement)
+            return 'SELECT 1', ()
+        return statement, parameters
+
+    return engine
+
+
+def create(engine, tbl, value):
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE analytics.{} (value INTEGER)'.format(tbl)))
+        connection.execute(text(
+            'INSERT INTO analytics.{} VALUES ({})'.format(tbl, value)))
+
+
+def tables(engine):
+    return sorted(inspect(engine).get_table_names(schema = 'analytics'))
+
+
+def values(engine, tbl):
+    with engine.connect() as connection:
+        return [row[0] for row in connection.execute(text(
+            'SELECT value FROM analytics.{}'.format(tbl)))]
+
+
+def test_first_load_renames_the_staging_table(engine):
+    create(engine, 'subscribers_staging', 1)
+
+    swap_tables(engine, 'subscribers_staging', 'subscribers', ['reader'])
+
+    assert tables(engine) == ['subscribers']
+    assert values(engine, 'subscribers') == [1]
+    assert engine.grants == [
+        'GRANT SELECT ON TABLE analytics.subscribers to reader']
+
+
+def test_replace_drops_the_old_table_and_grants_again(engine):
+    create(engine, 'subscribers', 1)
+    create(engine, 'subscribers_staging', 2)
+
+    swap_tables(engine, 'subscribers_staging', 'subscribers',
+        ['reader', 'analyst'])
+
+    assert tables(engine) == ['subscribers']
+    assert values(engine, 'subscribers') == [2]
+    assert engine.grants == [
+        'GRANT SELECT ON TABLE analytics.subscribers to reader',
+        'GRANT SELECT ON TABLE analytics.subscribers to analyst']
+
+
+def test_failure_between_renames_keeps_the_old_table(engine):
+    create(engine, 'subscribers', 1)
+    create(engine, 'subscribers_staging', 2)
+    engine.fail_on = 'ALTER TABLE analytics.subscribers_staging RENAME'
+
+    with pytest.raises(SwapFailed):
+        swap_tables(engine, 'subscribers_staging', 'subscribers', ['reader'])
+
+    assert tables(engine) == ['subscribers', 'subscribers_staging']
+    assert values(engine, 'subscribers') == [1]
+    assert engine.grants == []
@@ -1,7 +1,10 @@
 import boto3
-import logging
+import logging, json
+import numpy as np
 from io import BytesIO, StringIO
-from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, text, inspect
+from sqlalchemy.exc import DBAPIError
 from pandas.io.sql import get_schema
 from pathlib import Path
 from s3_read_write import S3ReadWrite
@@ -20,8 +23,59 @@ def upload_to_s3( data, start_date, end_date,
     return bucket, fullpath
 
 
+def slice_count(engine):
+    """Number of slices in the Redshift cluster, 1 on other databases."""
+    try:
+        with engine.connect() as connection:
+            return connection.execute(
+                text('SELECT COUNT(*) FROM stv_slices')).scalar()
+    except DBAPIError:
+        return 1
+
+
+def upload_parts_to_s3(data, start_date, end_date, n_slices,
+        parts_per_slice = 1, bucket = 'plated-redshift-etl',
+        dir = 'manual', subdir = 'propensity_model_subscribers',
+        max_workers = 4):
+    """Upload a dataframe as gzip csv parts, as many as a multiple of the
+    cluster's slices so that COPY loads them on every slice at once, and a
+    manifest listing them.
+    Args:
+        data (Pandas.DataFrame): the data to upload
+        start_date (str): start of the input period YYYY-MM-DD
+        end_date (str): end of the input period YYYY-MM-DD
+        n_slices (int): number of slices in the cluster
+        parts_per_slice (int): number of parts loaded by each slice
+        max_workers (int): number of parts uploaded at once
+    Returns:
+        tuple(str): the bucket and key of the manifest
+    """
+    s3_writer = S3ReadWrite(bucket = bucket, folder = dir)
+    name = 'eligible_users_{}_to_{}'.format(start_date, end_date)
+    n_parts = max(1, n_slices * parts_per_slice)
+    bounds = np.linspace(0, len(data), n_parts + 1).astype(int)
+
+    def upload_part(i):
+        return s3_writer.put_dataframe_to_S3(csv_path = subdir,
+            csv_name = '{}/part-{:04d}'.format(name, i),
+            dataframe = data.iloc[bounds[i]:bounds[i + 1]],
+            compression = 'gzip')
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        parts = list(executor.map(upload_part, range(n_parts)))
+    manifest = {'entries': [{'url': 's3://{}/{}'.format(bucket, part['key']),
+        'mandatory': True} for part in parts]}
+    manifest_key = '{}/{}/{}.manifest'.format(dir, subdir, name)
+    s3_writer.client.put_object(Bucket = bucket, Key = manifest_key,
+        Body = json.dumps(manifest).encode('utf-8'))
+    logging.info('{} gzip parts and manifest saved in S3 bucket at {}'.format(
+        n_parts, manifest_key))
+    return bucket, manifest_key
+
+
 def upload_to_redshift( bucket, filename, tbl_name, engine, data,
-        usernames, iam = 308127741254, role = 'RedshiftCopy'):
+        usernames, iam = 308127741254, role = 'RedshiftCopy',
+        manifest = False):
     iam_role = 'arn:aws:iam::{iam}:role/{role}'.format(
         iam = iam , role = role)
 
@@ -32,47 +86,84 @@ def upload_to_redshift( bucket, filename, tbl_name, engine, data,
 
     copy_data_query = """ COPY {table_name}
     FROM 's3://{bucket}/{filename}'
-         iam_role '{iam_role}'
+         iam_role '{iam_role}'{manifest}
          CSV BLANKSASNULL IGNOREHEADER AS 1 COMPUPDATE ON TIMEFORMAT 'auto'
          FILLRECORD STATUPDATE ON""".format(
          table_name = tbl,
          bucket = bucket,
          filename = filename,
-         iam_role = iam_role)
+         iam_role = iam_role,
+         manifest = ' MANIFEST GZIP' if manifest else '')
 
     grant_privilege_queries = ["GRANT SELECT ON TABLE {table} to {user}".format(
         table = tbl, user = username )
         for username in usernames]
 
     with engine.begin() as connection:
-        connection.execute(create_table_query)
+        connection.execute(text(create_table_query))
         logging.info('Created empty table {}'.format(tbl))
-        connection.execute(copy_data_query)
+        connection.execute(text(copy_data_query))
         logging.info("Data copied from s3://{bucket}/{filename} to {table}".format(
             bucket = bucket, filename = filename, table = tbl))
-        [connection.execute(grant_select)
+        [connection.execute(text(grant_select))
             for grant_select in grant_privilege_queries]
         logging.info('SELECT privileges granted to {}'.format(
             " ,".join(usernames)))
 
 
-def replace_table( data, engine, bucket, filename, tbl_name, usernames ):
-    drop_table = "DROP TABLE IF EXISTS analytics.{}".format(tbl_name)
+def swap_tables(engine, staging_tbl, tbl_name, usernames,
+        schema = 'analytics'):
+    """Replace a table with a fully loaded staging table by renaming them
+    inside one transaction, so readers see either the old or the new table
+    and never a missing one. Uses only SQL shared by Redshift and Postgres.
+    Args:
+        engine (sqlalchemy.engine.Engine): the database engine
+        staging_tbl (str): name of the loaded staging table in the schema
+        tbl_name (str): name of the table to replace in the schema
+        usernames (list[str]): users granted SELECT on the new table
+        schema (str): the schema of both tables
+    """
+    old_tbl = '{}_old'.format(tbl_name)
+    with engine.begin() as connection:
+        exists = inspect(connection).has_table(tbl_name, schema = schema)
+        connection.execute(text('DROP TABLE IF EXISTS {}.{}'.format(
+            schema, old_tbl)))
+        if exists:
+            connection.execute(text('ALTER TABLE {}.{} RENAME TO {}'.format(
+                schema, tbl_name, old_tbl)))
+        connection.execute(text('ALTER TABLE {}.{} RENAME TO {}'.format(
+            schema, staging_tbl, tbl_name)))
+        for username in usernames:
+            connection.execute(text('GRANT SELECT ON TABLE {}.{} to {}'.format(
+                schema, tbl_name, username)))
+        if exists:
+            connection.execute(text('DROP TABLE {}.{}'.format(
+                schema, old_tbl)))
+    logging.info('Table {}.{} swapped in for {}.{}'.format(
+        schema, staging_tbl, schema, tbl_name))
+
+
+def replace_table( data, engine, bucket, filename, tbl_name, usernames,
+        manifest = False ):
+    staging_tbl = '{}_staging'.format(tbl_name)
+    drop_table = "DROP TABLE IF EXISTS analytics.{}".format(staging_tbl)
     with engine.begin() as connection:
-        connection.execute(drop_table)
-    logging.info('Table analytics.{} dropped'.format(tbl_name))
+        connection.execute(text(drop_table))
 
     upload_to_redshift(bucket = bucket, filename = filename,
-        tbl_name = tbl_name, engine = engine,
-        data = data, usernames = usernames)
+        tbl_name = staging_tbl, engine = engine,
+        data = data, usernames = [], manifest = manifest)
+    swap_tables(engine, staging_tbl, tbl_name, usernames)
     logging.info('Table analytics.{} replaced'.format(tbl_name))
 
 
 def upload_eligible_subscribers(data, engine, start_date, end_date,
         usernames = ['production_read_only', 'analytics_team']):
-    # upload to S3
-    bucket, filename = upload_to_s3( data, start_date, end_date )
-    # replace table
+    # upload to S3 in gzip parts spread over the cluster's slices
+    bucket, filename = upload_parts_to_s3( data, start_date, end_date,
+        n_slices = slice_count(engine) )
+    # load into a staging table and swap it in
     replace_table( data, engine, bucket, filename,
         tbl_name = 'propensity_model_subscribers',
-        usernames = ['production_read_only', 'analytics_team'])
+        usernames = ['production_read_only', 'analytics_team'],
+        manifest = True)